@@ -1,12 +1,18 @@
 from __future__ import print_function
+import os
+import hashlib
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
 import numpy as np
 from nibabel import load as load_nii
 from scipy.ndimage.morphology import binary_dilation as imdilate
-from itertools import chain, product, izip
-from keras.utils import to_categorical
-from data_manipulation.generate_features import get_patches, get_mask_voxels
-from skimage.transform import resize
-from sklearn import decomposition
+from scipy.ndimage import gaussian_filter1d
+from itertools import product
+from keras.utils import to_categorical, Sequence
+from numpy.lib.stride_tricks import as_strided
+from utils import profile_stage
 
 
 """
@@ -15,44 +21,441 @@ from sklearn import decomposition
 """
 
 
+class VolumeCache(object):
+    """
+    Process-wide LRU cache of decoded NIfTI volumes. Each entry is keyed by
+    the file path, its modification time and the normalisation mode, so a
+    volume is only decompressed once while it fits inside the byte budget.
+    The cached arrays are shared, so they are returned as read-only.
+    """
+
+    def __init__(self, max_bytes=4 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._volumes = OrderedDict()
+        # The volumes might be prefetched from another thread (the decoding is done outside of the lock).
+        self._lock = Lock()
+
+    def get(self, name, normalise=False):
+        key = (os.path.abspath(name), os.path.getmtime(name), normalise)
+        with self._lock:
+            volume = self._volumes.pop(key, None)
+            if volume is not None:
+                self.hits += 1
+                # Reinserting the volume marks it as the most recently used one.
+                self._volumes[key] = volume
+                return volume
+            self.misses += 1
+        with profile_stage('decode') as stage:
+            volume = np.asarray(load_nii(name).dataobj)
+            stage['bytes'] = volume.nbytes
+        if normalise:
+            # Float32 volumes are normalised in place (np.asarray already returns a new array).
+            in_place = volume.dtype == np.float32 and volume.flags.writeable
+            volume = norm(volume, out=np.squeeze(volume) if in_place else None)
+        volume.flags.writeable = False
+        with self._lock:
+            old_volume = self._volumes.pop(key, None)
+            if old_volume is not None:
+                self.nbytes -= old_volume.nbytes
+            self._volumes[key] = volume
+            self.nbytes += volume.nbytes
+            self._evict()
+        return volume
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._volumes.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._volumes) > 1:
+            _, old_volume = self._volumes.popitem(last=False)
+            self.nbytes -= old_volume.nbytes
+
+
+volume_cache = VolumeCache()
+
+
+def load_volume(name, normalise=False):
+    return volume_cache.get(name, normalise=normalise)
+
+
+def set_volume_cache_size(max_bytes):
+    volume_cache.resize(max_bytes)
+
+
+volume_store = {'path': None}
+
+
+def get_cache_path(*names):
+    # Default folder for the files we can always rebuild (like the volume store) when none is given.
+    cache_root = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_root, 'challenges2018', *names)
+
+
+def get_dataset_name(path):
+    # Unique name for the files derived from a dataset folder (inside shared folders like the cache one).
+    path = os.path.abspath(path)
+    return '%s-%s' % (os.path.basename(path), hashlib.md5(path).hexdigest()[:8])
+
+
+def get_writable_path(paths):
+    # First folder of the list that exists (or can be created) and can be written (None if there are none).
+    for path in paths:
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        except OSError:
+            continue
+        if os.access(path, os.W_OK):
+            return path
+    return None
+
+
+def set_volume_store(path):
+    # The store holds one float32 (channels, X, Y, Z) array per patient with all the normalised
+    # modalities, so later runs (and several workers) can memory-map it instead of decoding the NIfTIs.
+    if path is not None and not os.path.isdir(path):
+        os.makedirs(path)
+    volume_store['path'] = path
+    # The loader workers have a copy of the old path, so we start new ones.
+    close_loader()
+
+
+def get_store_name(image_names, store_path, normalise=True, key=None):
+    # The key identifies other arrays derived from the same images (like the reshaped survival data).
+    p_name = os.path.basename(os.path.dirname(os.path.abspath(image_names[0])))
+    names_hash = hashlib.md5(';'.join(map(os.path.abspath, image_names))).hexdigest()[:8]
+    key_sufix = '' if key is None else '-' + hashlib.md5(key).hexdigest()[:8]
+    return os.path.join(
+        store_path, '%s-%s%s%s.npy' % (p_name, names_hash, '' if normalise else '-raw', key_sufix)
+    )
+
+
+def store_patient(image_names, store_name, normalise=True):
+    # We write to a temporary file first and rename it at the end, so a half-written
+    # array is never memory-mapped by another process.
+    tmp_name = '%s.%d.tmp' % (store_name, os.getpid())
+    volumes = None
+    for i, name in enumerate(image_names):
+        with profile_stage('decode') as stage:
+            volume = np.squeeze(np.asarray(load_nii(name).dataobj))
+            stage['bytes'] = volume.nbytes
+        if volumes is None:
+            volumes = np.lib.format.open_memmap(
+                tmp_name,
+                mode='w+',
+                dtype=np.float32 if normalise else volume.dtype,
+                shape=(len(image_names),) + volume.shape
+            )
+        # The normalised volume is written directly to the store.
+        if normalise:
+            norm(volume, out=volumes[i])
+        else:
+            volumes[i] = volume
+    volumes.flush()
+    del volumes
+    os.rename(tmp_name, store_name)
+
+
+def load_patient(image_names, normalise=True):
+    store_path = volume_store['path']
+    if store_path is None:
+        return map(lambda image: load_volume(image, normalise=normalise), image_names)
+    store_name = get_store_name(image_names, store_path, normalise)
+    store_time = os.path.getmtime(store_name) if os.path.isfile(store_name) else None
+    if store_time is None or any(map(lambda image: os.path.getmtime(image) > store_time, image_names)):
+        store_patient(image_names, store_name, normalise)
+    return np.load(store_name, mmap_mode='r')
+
+
+def load_labels(label_name):
+    return np.squeeze(load_patient([label_name], normalise=False)[0])
+
+
+def preprocess_patient(image_names):
+    # Only used to fill the store (we do not want to send the whole array back from a worker).
+    load_patient(image_names)
+
+
+def preprocess_labels(label_name):
+    load_patient([label_name], normalise=False)
+
+
+def preprocess_patients(list_of_image_names, store_path, label_names=None, verbose=False):
+    # The labels are also stored before training, so the streaming threads only read memory-mapped
+    # arrays (they never write to the store or decode a NIfTI).
+    set_volume_store(store_path)
+    if verbose:
+        print('%s- Preprocessing %d patients' % (' '.join([''] * 12), len(list_of_image_names)))
+    loader_map(preprocess_patient, list_of_image_names)
+    if label_names is not None:
+        loader_map(preprocess_labels, label_names)
+
+
+def get_file_hash(name, block_size=2 ** 20):
+    file_hash = hashlib.md5()
+    with open(name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_file_stat(name):
+    stat = os.stat(name)
+    return stat.st_size, stat.st_mtime
+
+
+class FeatureStore(object):
+    """
+    Persistent (pickled) table of features computed from a set of files. Each entry is keyed by name and
+    keeps the hashes of the files used to compute it, so it's only computed again when any of them
+    changes (files are only hashed again when their size or modification time changes). The table is
+    saved after each new entry, so an interrupted extraction resumes where it stopped.
+    """
+
+    def __init__(self, filename):
+        # Without a filename, the table is only kept in memory.
+        self.filename = filename
+        self.table = dict()
+        if filename is not None:
+            try:
+                with open(filename, 'rb') as f:
+                    self.table = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                pass
+
+    def get(self, key, source_names, extractor):
+        """
+        Function to get the features for a key (computing them if needed).
+        :param key: Key of the entry (any hashable object).
+        :param source_names: Names of the files used to compute the features.
+        :param extractor: Function that computes the features from the file names.
+        :return: The features returned by extractor.
+        """
+        entry = self.table.get(key)
+        stats = map(get_file_stat, source_names)
+        if entry is not None and entry['stats'] == stats:
+            return entry['features']
+        hashes = map(get_file_hash, source_names)
+        if entry is None or entry['hashes'] != hashes:
+            entry = {'hashes': hashes, 'features': extractor(*source_names)}
+        entry['stats'] = stats
+        self.table[key] = entry
+        self.save()
+        return entry['features']
+
+    def save(self):
+        # Same as with the volume store, the table is written to a temporary file and renamed.
+        if self.filename is None:
+            return
+        tmp_name = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp_name, 'wb') as f:
+            pickle.dump(self.table, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_name, self.filename)
+
+
+catalog_store = {'path': None}
+
+
+def set_catalog_store(path):
+    # Folder for the catalogs of all the datasets. By default, each catalog is saved in a hidden folder
+    # inside its dataset folder (or in the cache folder, if the dataset folder is read-only).
+    catalog_store['path'] = path
+
+
+def get_catalog_path(path):
+    catalog_name = get_dataset_name(path)
+    if catalog_store['path'] is not None:
+        return get_writable_path([os.path.join(catalog_store['path'], catalog_name)])
+    return get_writable_path([os.path.join(path, '.catalog'), get_cache_path('catalogs', catalog_name)])
+
+
+class PatientCatalog(object):
+    """
+    On-disk index (pickled) of the patients of a dataset folder (one folder per patient). The list of
+    patients is only read again when the modification time of the dataset folder changes (a patient
+    was added or removed). The files of each patient are indexed the first time they are queried
+    (shape, voxel spacing and hash) and they are only indexed again if their size or modification
+    time changes. The nonzero bounding box of a file is also stored once it's computed.
+    If there is no writable folder for it (see get_catalog_path), the catalog is only kept in memory.
+    """
+
+    def __init__(self, path, catalog_name='patient_catalog.pkl'):
+        self.path = os.path.abspath(path)
+        # The catalog is saved in a hidden folder, so saving it does not change the dataset folder.
+        catalog_path = get_catalog_path(self.path)
+        self.filename = os.path.join(catalog_path, catalog_name) if catalog_path is not None else None
+        self.catalog = {'mtime': None, 'patients': list(), 'files': dict()}
+        if self.filename is not None:
+            try:
+                with open(self.filename, 'rb') as f:
+                    self.catalog = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                pass
+        self.update()
+
+    def update(self):
+        path_mtime = os.path.getmtime(self.path)
+        if path_mtime != self.catalog['mtime']:
+            patients = sorted(filter(
+                lambda f: not f.startswith('.') and os.path.isdir(os.path.join(self.path, f)),
+                os.listdir(self.path)
+            ))
+            # We drop the files of the patients that are not there anymore.
+            patient_set = set(patients)
+            self.catalog['files'] = {
+                name: info for name, info in self.catalog['files'].items()
+                if os.path.basename(os.path.dirname(name)) in patient_set
+            }
+            self.catalog['patients'] = patients
+            self.catalog['mtime'] = path_mtime
+            self.save()
+
+    def get_patients(self):
+        return self.catalog['patients']
+
+    def get_names(self, sufix):
+        return map(lambda p: os.path.join(self.path, p, p + sufix), self.catalog['patients'])
+
+    def get_file_info(self, name):
+        """
+        Function to get the information of a file (indexing it if needed).
+        :param name: Name of the file (inside a patient folder).
+        :return: Dictionary with the shape, spacing, hash (and bounding box, if computed) of the file.
+        """
+        name = os.path.abspath(name)
+        stat = get_file_stat(name)
+        info = self.catalog['files'].get(name)
+        if info is None or info['stat'] != stat:
+            header = load_nii(name).header
+            info = {
+                'stat': stat,
+                'shape': header.get_data_shape(),
+                'spacing': header.get_zooms(),
+                'hash': get_file_hash(name),
+            }
+            self.catalog['files'][name] = info
+            self.save()
+        return info
+
+    def get_hash(self, name):
+        return self.get_file_info(name)['hash']
+
+    def get_bounding_box(self, name):
+        info = self.get_file_info(name)
+        if 'bounding_box' not in info:
+            volume = load_volume(name)
+            info['bounding_box'] = get_bounding_box(volume)
+            self.save()
+        return info['bounding_box']
+
+    def save(self):
+        # Same as with the feature store, the catalog is written to a temporary file and renamed.
+        if self.filename is None:
+            return
+        tmp_name = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp_name, 'wb') as f:
+            pickle.dump(self.catalog, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_name, self.filename)
+
+
+patient_catalogs = dict()
+
+
+def get_patient_catalog(path):
+    # Only one catalog per dataset folder (and process).
+    path = os.path.abspath(path)
+    try:
+        catalog = patient_catalogs[path]
+    except KeyError:
+        catalog = PatientCatalog(path)
+        patient_catalogs[path] = catalog
+    return catalog
+
+
+loader = {'workers': 1, 'pool': None}
+
+
+def set_loader_workers(workers):
+    close_loader()
+    loader['workers'] = max(workers, 1)
+
+
+def close_loader():
+    if loader['pool'] is not None:
+        loader['pool'].shutdown()
+        loader['pool'] = None
+
+
+def loader_map(func, *iterables):
+    # Patients are independent, so with more than one worker we load them in a process pool
+    # (map keeps the results in the same order as the serial version). The pool is kept between calls.
+    # Each worker has its own volume cache and any worker can get any patient, so the workers are only
+    # used with the volume store. Through the caches, every call would decode all the patients again.
+    if loader['workers'] > 1 and volume_store['path'] is not None:
+        if loader['pool'] is None:
+            loader['pool'] = ProcessPoolExecutor(max_workers=loader['workers'])
+        return list(loader['pool'].map(func, *iterables))
+    return map(func, *iterables)
+
+
 def labels_generator(image_names):
     for patient in image_names:
-        yield np.squeeze(np.asarray(load_nii(patient).dataobj))
+        yield load_labels(patient)
 
 
 def load_images(image_names):
-    return map(lambda image: norm(np.asarray(load_nii(image).dataobj)), image_names)
+    return load_patient(image_names)
 
 
 def get_bounding_centers(image_names, patch_width, overlap=0, offset=0):
-    list_of_centers = map(
-        lambda names: get_bounding_blocks(
-            load_nii(names[0]).get_data(),
-            patch_width,
-            overlap=overlap,
-            offset=offset
-        ),
-        image_names
-    )
+    # The bounding boxes come from the patient catalog (they are only computed once per image).
+    def get_patient_blocks(names):
+        catalog = get_patient_catalog(os.path.dirname(os.path.dirname(os.path.abspath(names[0]))))
+        min_coord, max_coord = catalog.get_bounding_box(names[0])
+        return get_box_blocks(min_coord, max_coord, patch_width, overlap=overlap, offset=offset)
+
+    list_of_centers = map(get_patient_blocks, image_names)
     return list_of_centers
 
 
+def get_bounding_box(mask):
+    # Minimum and maximum coordinates of the nonzero voxels
+    mask_voxels = np.stack(np.nonzero(np.asarray(mask).astype(dtype=np.bool)))
+    return mask_voxels.min(axis=1), mask_voxels.max(axis=1)
+
+
 def get_bounding_blocks(mask, block_size, overlap=0, offset=0):
+    min_coord, max_coord = get_bounding_box(mask)
+    return get_box_blocks(min_coord, max_coord, block_size, overlap=overlap, offset=offset)
+
+
+def get_box_blocks(min_coord, max_coord, block_size, overlap=0, offset=0):
     # Init
     half_size = block_size / 2
     overlap = min(overlap, block_size-1)
 
     # Bounding box
-    min_coord = np.stack(np.nonzero(mask.astype(dtype=np.bool))).min(axis=1) - offset
-    max_coord = np.stack(np.nonzero(mask.astype(dtype=np.bool))).max(axis=1) + offset
+    min_coord = np.asarray(min_coord) - offset
+    max_coord = np.asarray(max_coord) + offset
 
-    # Centers
+    # Centers (in the same order as itertools.product)
     global_centers = map(
-        lambda (init, end): range(init + half_size, end, block_size - overlap),
+        lambda (init, end): np.arange(init + half_size, end, block_size - overlap),
         zip(min_coord, max_coord)
     )
+    global_centers = np.meshgrid(*global_centers, indexing='ij')
 
-    return list(product(*global_centers))
+    return np.stack(map(np.ravel, global_centers), axis=1).astype(np.int16)
 
 
 def get_mask_centers(masks, dilation=2):
@@ -61,36 +464,226 @@ def get_mask_centers(masks, dilation=2):
 
 
 def get_mask_blocks(mask, dilation=2):
-    return get_mask_voxels(imdilate(mask, iterations=dilation))
+    return np.stack(np.nonzero(imdilate(mask, iterations=dilation)), axis=1).astype(np.int16)
+
+
+def pack_centers(list_of_centers):
+    # The centers for all the images are stored as an (N, 4) array of (image index, x, y, z).
+    return np.concatenate(
+        map(
+            lambda (i, centers): np.concatenate(
+                [np.full((len(centers), 1), i), np.reshape(centers, (-1, 3))],
+                axis=1
+            ),
+            enumerate(list_of_centers)
+        )
+    ).astype(np.int16)
 
 
 def centers_and_idx(centers, n_images):
     # This function is used to decompress the centers with image references into image indices and centers.
-    centers = [list(map(lambda z: tuple(z[1]) if z[0] == im else [], centers)) for im in range(n_images)]
-    idx = [map(lambda (a, b): [a] if b else [], enumerate(c)) for c in centers]
-    centers = [filter(bool, c) for c in centers]
-    idx = list(chain(*[chain(*i) for i in idx]))
+    # The centers are an (N, 4) array of (image index, x, y, z) and the indices are the ones
+    # that sort the original centers by image (keeping their original order inside each image).
+    centers = np.reshape(np.asarray(centers, dtype=np.int16), (-1, 4))
+    idx = np.argsort(centers[:, 0], kind='mergesort')
+    idx = idx[centers[idx, 0] < n_images]
+    image_splits = np.cumsum(np.bincount(centers[idx, 0], minlength=n_images))[:n_images - 1]
+    centers = np.split(centers[idx, 1:], image_splits)
     return centers, idx
 
 
+def get_patient_patches(image_names, centers, size):
+    return get_patches_block(load_patient(image_names), centers, size)
+
+
 def get_patches_list(list_of_image_names, centers_list, size):
-    patch_list = [
-        np.stack(
-            map(
-                lambda image: get_patches(norm(np.asarray(load_nii(image).dataobj)), centers, size),
-                image_names
-            ),
-            axis=1
-        )
-        for image_names, centers in zip(list_of_image_names, centers_list) if centers
+    names_and_centers = [
+        (image_names, centers)
+        for image_names, centers in zip(list_of_image_names, centers_list) if len(centers) > 0
     ]
+    if not names_and_centers:
+        return []
+    list_of_image_names, centers_list = zip(*names_and_centers)
+    # With several loader workers, the decoding and normalisation stages of each patient are run
+    # (and profiled) on the workers, so this stage also includes them.
+    with profile_stage('patches') as stage:
+        patch_list = loader_map(
+            get_patient_patches,
+            list_of_image_names,
+            centers_list,
+            [size] * len(centers_list)
+        )
+        stage['patches'] = sum(map(len, patch_list))
+        stage['bytes'] = sum(map(lambda patches: patches.nbytes, patch_list))
     return patch_list
 
 
-def norm(image):
+def get_patches_block(image, centers, size, datatype=None):
+    """
+    Function to extract all the patches for a list of centers in one pass. The region covered by
+    the patches is copied once (zero padded if any center is close to or outside of the image
+    limits) and a strided view of all the possible windows is indexed with the centers. That returns a contiguous (N, w, w, w) block
+    (or (N, C, w, w, w) when the image is a list or array of channels).
+    :param image: Single volume or sequence of volumes (channels) with the same shape.
+    :param centers: List of center coordinates.
+    :param size: Size of the patches.
+    :param datatype: Data type of the patches (the image's type by default).
+    :return: Block of patches.
+    """
+    size = tuple(size)
+    multichannel = np.ndim(image[0]) == len(size)
+    channels = image if multichannel else [image]
+    shape = np.array(np.shape(channels[0]))
+    datatype = channels[0].dtype if datatype is None else datatype
+    centers = np.reshape(np.asarray(centers, dtype=np.int64), (-1, len(size)))
+    if len(centers) == 0:
+        empty_shape = (0, len(channels)) + size if multichannel else (0,) + size
+        return np.zeros(empty_shape, dtype=datatype)
+
+    # We only copy the region covered by the patches (the parts outside of the image stay as zero padding).
+    half_size = np.array(size) / 2
+    region_ini = centers.min(axis=0) - half_size
+    region_end = centers.max(axis=0) - half_size + size
+    image_ini = np.maximum(region_ini, 0)
+    image_end = np.minimum(region_end, shape)
+    region = np.zeros((len(channels),) + tuple(region_end - region_ini), dtype=datatype)
+    if np.all(image_end > image_ini):
+        image_slices = tuple(map(lambda (ini, end): slice(ini, end), zip(image_ini, image_end)))
+        region_slices = tuple(
+            map(lambda (ini, end): slice(ini, end), zip(image_ini - region_ini, image_end - region_ini))
+        )
+        for region_i, channel in zip(region, channels):
+            region_i[region_slices] = channel[image_slices]
+
+    # Strided view with all the windows (X', Y', Z', C, w, w, w) and fancy indexing with the first voxel.
+    windows_shape = tuple(np.array(region.shape[1:]) - size + 1)
+    windows = as_strided(
+        region,
+        shape=windows_shape + (len(channels),) + size,
+        strides=region.strides[1:] + region.strides
+    )
+    patches = windows[tuple((centers - half_size - region_ini).T)]
+    return patches if multichannel else patches[:, 0]
+
+
+class PatchSequence(Sequence):
+    """
+    Keras Sequence that extracts the patches (and their labels) for each batch on the fly, instead
+    of loading all of them in memory before training. Each batch only reads the region of
+    the volumes it needs (which is cheap when using the memory-mapped store or the volume cache).
+    The label_sizes parameter defines the outputs: None for the label of the center and a patch size
+    for the labels of a patch. With sparse labels, the outputs are the (uint8) label indices.
+    The batches are drawn from all the patients, so the volumes should be in the memory-mapped
+    store (see preprocess_patients). Through the volume cache, almost every batch would decode
+    most of the patients again.
+    """
+
+    def __init__(
+            self,
+            image_names,
+            label_names,
+            list_of_centers,
+            patch_size,
+            label_sizes,
+            nlabels,
+            batch_size,
+            indices=None,
+            shuffle=True,
+            sparse=False,
+            datatype=np.float32
+    ):
+        self.image_names = image_names
+        self.label_names = label_names
+        self.patch_size = tuple(patch_size)
+        self.label_sizes = label_sizes
+        self.nlabels = nlabels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.sparse = sparse
+        self.datatype = datatype
+        self.n_channels = len(image_names[0])
+        packed_centers = pack_centers(list_of_centers)
+        self.patients = packed_centers[:, 0]
+        self.centers = packed_centers[:, 1:]
+        self.indices = np.arange(len(self.centers)) if indices is None else np.asarray(indices)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / float(self.batch_size)))
+
+    def __getitem__(self, index):
+        with profile_stage('batches') as stage:
+            x, y = self._get_batch(index)
+            stage['patches'] = len(x)
+            stage['bytes'] = x.nbytes
+        return x, y
+
+    def _get_batch(self, index):
+        batch = self.indices[index * self.batch_size:(index + 1) * self.batch_size]
+        patients = self.patients[batch]
+        centers = self.centers[batch]
+
+        x = np.empty((len(batch), self.n_channels) + self.patch_size, dtype=self.datatype)
+        y_dims = 1 if self.sparse else self.nlabels
+        y = map(
+            lambda size: np.empty(
+                (len(batch), y_dims) if size is None else (len(batch), np.prod(size), y_dims),
+                dtype=np.uint8 if self.sparse else np.float32
+            ),
+            self.label_sizes
+        )
+        for p in np.unique(patients):
+            p_batch = patients == p
+            p_centers = centers[p_batch]
+            x[p_batch] = get_patches_block(load_patient(self.image_names[p]), p_centers, self.patch_size)
+            labels = load_labels(self.label_names[p])
+            for y_i, size in zip(y, self.label_sizes):
+                if size is None:
+                    y_p = np.minimum(labels[tuple(p_centers.T)], self.nlabels - 1)
+                else:
+                    y_p = np.minimum(get_patches_block(labels, p_centers, size), self.nlabels - 1)
+                if self.sparse:
+                    y_i[p_batch] = y_p.reshape((len(y_p),) + y_i.shape[1:])
+                else:
+                    y_i[p_batch] = to_categorical(y_p, num_classes=self.nlabels).reshape((len(y_p),) + y_i.shape[1:])
+
+        return x, y[0] if len(y) == 1 else y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.indices)
+
+
+def norm(image, mask=None, out=None):
+    """
+    Function to normalise an image with the mean and standard deviation of its nonzero voxels (or
+    the voxels of a brain mask). The statistics are computed in one pass, slice by slice (so only
+    one slice is copied at a time), and the result is written to a float32 array. That array
+    can be preallocated (or the image itself, to normalise it in place).
+    :param image: Image to normalise.
+    :param mask: Mask with the voxels used for the statistics (the nonzero ones by default).
+    :param out: Array for the normalised image (a new float32 array by default).
+    :return: Normalised image.
+    """
     image = np.squeeze(image)
-    image_nonzero = image[np.nonzero(image)]
-    return (image - image_nonzero.mean()) / image_nonzero.std()
+    with profile_stage('norm') as stage:
+        n_voxels = 0
+        total = 0.
+        total_sq = 0.
+        for i, image_slice in enumerate(image):
+            values = image_slice[image_slice != 0 if mask is None else mask[i]].astype(np.float64)
+            n_voxels += len(values)
+            total += values.sum()
+            total_sq += values.dot(values)
+        mean = total / n_voxels
+        std = np.sqrt(total_sq / n_voxels - mean ** 2)
+
+        if out is None:
+            out = np.empty(image.shape, dtype=np.float32)
+        np.subtract(image, np.float32(mean), out=out, casting='unsafe')
+        out *= np.float32(1. / std)
+        stage['bytes'] = image.nbytes
+    return out
 
 
 def get_data(
@@ -107,6 +700,87 @@ def get_data(
     return x
 
 
+def get_resize_matrix(in_size, out_size, datatype=np.float32):
+    # Linear interpolation along one axis as an (out, in) matrix. The coordinates are the same
+    # as the ones used by skimage's resize (the borders are clamped).
+    coords = np.clip((np.arange(out_size) + 0.5) * in_size / float(out_size) - 0.5, 0, in_size - 1)
+    ini = np.floor(coords).astype(np.int)
+    end = np.minimum(ini + 1, in_size - 1)
+    weights = (coords - ini).astype(datatype)
+    matrix = np.zeros((out_size, in_size), dtype=datatype)
+    np.add.at(matrix, (np.arange(out_size), ini), 1 - weights)
+    np.add.at(matrix, (np.arange(out_size), end), weights)
+    return matrix
+
+
+def separable_resize(image, output_shape, anti_aliasing=True):
+    """
+    Function to resize an image with linear interpolation, one axis at a time (the interpolation and the
+    anti-aliasing gaussian filter are both separable). Each axis is a matrix product with the
+    interpolation weights, so the data type of the image is kept.
+    :param image: Image to resize.
+    :param output_shape: Final shape of the image.
+    :param anti_aliasing: Whether to smooth the axes that are downsampled first (same sigma as skimage).
+    :return: Resized image.
+    """
+    for axis, (in_size, out_size) in enumerate(zip(image.shape, output_shape)):
+        if in_size == out_size:
+            continue
+        if anti_aliasing and in_size > out_size:
+            sigma = (in_size / float(out_size) - 1) / 2
+            image = gaussian_filter1d(image, sigma, axis=axis, mode='constant')
+        resize_matrix = get_resize_matrix(in_size, out_size, datatype=image.dtype)
+        image = np.moveaxis(np.tensordot(resize_matrix, image, axes=(1, axis)), 0, axis)
+    return image
+
+
+def get_pca_components(data, components=3):
+    # PCA of the channels (C, ...) using the eigenvectors of their (C, C) covariance matrix
+    # (there are only a few channels, so that's faster than a SVD of the whole (voxels, C) matrix).
+    x = np.reshape(data, (len(data), -1))
+    x = x - np.mean(x, axis=1, keepdims=True)
+    _, eigenvectors = np.linalg.eigh(x.dot(x.T))
+    x_pca = eigenvectors[:, ::-1][:, :components].T.dot(x)
+    # Same sign convention as sklearn (the biggest absolute value of each component is positive).
+    max_abs = x_pca[np.arange(components), np.argmax(np.abs(x_pca), axis=1)]
+    x_pca *= np.sign(max_abs)[:, np.newaxis].astype(x_pca.dtype)
+    return np.reshape(x_pca, (components,) + np.shape(data)[1:])
+
+
+def get_reshaped_patient(image_names, slices, slice_shape, n_slices=20, datatype=np.float32, components=3):
+    # With a volume store, the reshaped data is also stored (it depends on the slices and final shape).
+    store_path = volume_store['path']
+    if store_path is not None:
+        key = '%s;%s;%d;%d' % (
+            ';'.join(map(lambda s: '%s:%s' % (s.start, s.stop), slices)),
+            'x'.join(map(str, slice_shape)),
+            n_slices,
+            components
+        )
+        store_name = get_store_name(image_names, store_path, key=key)
+        store_time = os.path.getmtime(store_name) if os.path.isfile(store_name) else None
+        if store_time is not None and all(map(lambda image: os.path.getmtime(image) <= store_time, image_names)):
+            return np.load(store_name).astype(datatype)
+
+    # Load the images first
+    data = np.stack(map(lambda im: load_volume(im)[slices], image_names), axis=0).astype(np.float32)
+
+    # PCA and normalisation of the components
+    data_pca = get_pca_components(data, components)
+    data_pca = (data_pca - np.min(data_pca, axis=0)) / (np.max(data_pca, axis=0) - np.min(data_pca, axis=0))
+
+    # Prepare data for the final slice shape
+    final_shape = (components,) + tuple(slice_shape) + (n_slices,)
+    data_final = np.moveaxis(separable_resize(data_pca, final_shape), 0, -1).astype(datatype)
+
+    if store_path is not None:
+        tmp_name = '%s.%d.tmp.npy' % (store_name[:-4], os.getpid())
+        np.save(tmp_name, data_final)
+        os.rename(tmp_name, store_name)
+
+    return data_final
+
+
 def get_reshaped_data(
         image_names,
         slices,
@@ -118,93 +792,102 @@ def get_reshaped_data(
     if verbose:
         print('%s- Loading x' % ' '.join([''] * 12))
 
-    def load_patient_data(names, slices, components=3):
-        # Load the images first
-        data = np.stack(
-            map(lambda im: load_nii(im).get_data()[slices].astype(np.float32), names),
-            axis=0,
-        ).astype(dtype=datatype)
+    # Each patient has its own PCA, so they are independent (and can be run in parallel with the loader pool).
+    n_patients = len(image_names)
+    x = loader_map(
+        get_reshaped_patient,
+        image_names,
+        slices,
+        [slice_shape] * n_patients,
+        [n_slices] * n_patients,
+        [datatype] * n_patients
+    )
 
-        # Prepare data for PCA and do it
-        pca = decomposition.PCA(n_components=components)
-        data_shape = (components,) + data.shape[1:]
-        data_pca = pca.fit_transform(np.reshape(data, (len(data), -1)).T).T
-        data_pca = np.reshape(data_pca, data_shape)
-        data_pca = (data_pca - np.min(data_pca, axis=0)) / (np.max(data_pca, axis=0) - np.min(data_pca, axis=0))
+    return x
 
-        # Prepare data for the final slice shape
-        final_shape = (3,) + slice_shape + (n_slices,)
-        data_final = resize(data_pca, final_shape, mode='constant', anti_aliasing=True)
-        return np.moveaxis(data_final, 0, -1)
 
-    x = map(lambda (i, s): load_patient_data(i, s), zip(image_names, slices))
+def get_patient_labels(label_name, centers, nlabels):
+    labels = load_labels(label_name)
+    centers = np.reshape(centers, (-1, labels.ndim))
+    return np.minimum(labels[tuple(centers.T)], nlabels - 1, dtype=np.int8)
 
-    return x
+
+def get_patient_patch_labels(label_name, centers, output_size, nlabels):
+    labels = load_labels(label_name)
+    return np.minimum(get_patches_block(labels, centers, output_size), nlabels - 1, dtype=np.int8)
 
 
-def get_labels(label_names, list_of_centers, nlabels, verbose=False):
+def get_labels(label_names, list_of_centers, nlabels, verbose=False, sparse=False):
     if verbose:
         print('%s- Loading y' % ' '.join([''] * 12))
-    y = map(
-            lambda (labels, centers): np.minimum(
-                map(lambda c: labels[c], centers),
-                nlabels - 1,
-                dtype=np.int8
-            ),
-            izip(labels_generator(label_names), list_of_centers)
+    with profile_stage('labels') as stage:
+        y = loader_map(
+            get_patient_labels,
+            label_names,
+            list_of_centers,
+            [nlabels] * len(list_of_centers)
         )
-    y = map(
-        lambda y_i: to_categorical(y_i, num_classes=nlabels),
-        y
-    )
+        stage['patches'] = sum(map(len, y))
+    with profile_stage('one_hot') as stage:
+        if sparse:
+            y = map(lambda y_i: y_i.astype(np.uint8).reshape((len(y_i), 1)), y)
+        else:
+            y = map(
+                lambda y_i: to_categorical(y_i, num_classes=nlabels),
+                y
+            )
+        stage['patches'] = sum(map(len, y))
+        stage['bytes'] = sum(map(lambda y_i: y_i.nbytes, y))
     return y
 
 
-def get_patch_labels(label_names, list_of_centers, output_size, nlabels, verbose=False):
+def get_patch_labels(label_names, list_of_centers, output_size, nlabels, verbose=False, sparse=False):
     if verbose:
         print('%s- Loading y' % ' '.join([''] * 12))
-    y = map(
-            lambda (labels, centers): np.minimum(
-                get_patches(labels, centers, output_size),
-                nlabels - 1,
-                dtype=np.int8
-            ),
-            izip(labels_generator(label_names), list_of_centers)
+    with profile_stage('labels') as stage:
+        y = loader_map(
+            get_patient_patch_labels,
+            label_names,
+            list_of_centers,
+            [output_size] * len(list_of_centers),
+            [nlabels] * len(list_of_centers)
         )
-    y = map(
-        lambda y_i: to_categorical(y_i, num_classes=nlabels).reshape((len(y_i), -1, nlabels)),
-        y
-    )
+        stage['patches'] = sum(map(len, y))
+    with profile_stage('one_hot') as stage:
+        if sparse:
+            y = map(lambda y_i: y_i.astype(np.uint8).reshape((len(y_i), -1, 1)), y)
+        else:
+            y = map(
+                lambda y_i: to_categorical(y_i, num_classes=nlabels).reshape((len(y_i), -1, nlabels)),
+                y
+            )
+        stage['patches'] = sum(map(len, y))
+        stage['bytes'] = sum(map(lambda y_i: y_i.nbytes, y))
     return y
 
 
 def get_patches_roi(
         image_names,
         label_names,
-        roi,
+        rois,
         nblocks,
         nlabels,
         datatype=np.float32,
         verbose=False
 ):
-    centers = get_bounding_blocks(roi, 3, 2)
+    # One ROI mask per image (the centers of each image are an int16 (N, 3) array).
+    list_of_centers = map(lambda roi: get_bounding_blocks(roi, 3, 2), rois)
     if verbose:
         print('%s- Loading x' % ' '.join([''] * 12))
-    x_d = filter(lambda z: z.any(), get_patches_list(image_names, centers, (3, 3, 3)))
+    x_d = filter(lambda z: z.any(), get_patches_list(image_names, list_of_centers, (3, 3, 3)))
     x_d = map(lambda x_i: x_i.astype(dtype=datatype), x_d)
 
-    x_c = filter(lambda z: z.any(), get_patches_list(image_names, centers, (nblocks * 2 + 3,) * 3))
+    x_c = filter(lambda z: z.any(), get_patches_list(image_names, list_of_centers, (nblocks * 2 + 3,) * 3))
     x_c = map(lambda x_i: x_i.astype(dtype=datatype), x_c)
 
-    if verbose:
-        print('%s- Loading y' % ' '.join([''] * 12))
-    y = map(
-            lambda (l, lc): np.minimum(map(lambda c: l[c], lc), nlabels - 1, dtype=np.int8),
-            zip(labels_generator(label_names), centers)
-        )
     y = map(
-        lambda y_i: to_categorical(y_i, num_classes=nlabels).reshape((len(y_i), -1, nlabels)),
-        y
+        lambda y_i: y_i.reshape((len(y_i), -1, nlabels)),
+        get_labels(label_names, list_of_centers, nlabels, verbose=verbose)
     )
 
     return [x_d, x_c], y
@@ -226,16 +909,207 @@ def majority_voting_patches(patches, image_size, patch_size, centers, datatype=n
     image_explored = np.zeros(image_size, dtype=np.float32)
 
     # We assume that the centers and their corresponding patches are inside the image boundaries.
-    slices = map(
-        lambda center: map(
-            lambda (c_idx, s_idx): slice(c_idx - s_idx / 2, c_idx + (s_idx - s_idx / 2)),
-            zip(center, patch_size)
-        ),
-        centers
-    )
-    for slice_i, patch_i in zip(slices, patches):
-        image[slice_i] += patch_i[:, -1].reshape(patch_size)
-        image_explored[slice_i] += np.ones(patch_size)
+    patch_size = tuple(patch_size)
+    patches = np.asarray(patches)[:, :, -1].reshape((-1,) + patch_size)
+    starts = np.asarray(centers) - np.array(patch_size) / 2
+    blend_patches(image, image_explored, patches, starts, np.ones(patch_size, dtype=np.float32))
     image_explored[image_explored == 0] = 1
     voting = np.divide(image, image_explored)
     return (voting > 0.5).astype(dtype=datatype), voting
+
+
+def blend_patches(accumulator, weights_accumulator, patches, starts, weights):
+    """
+    Function to add weighted patches to the accumulators. The tiles with the same phase (their starts
+    modulo the patch size) never overlap, so the accumulators are seen as a grid of patch-sized blocks
+    starting at that phase (a strided view) and all the tiles of a phase are added at once by indexing
+    the blocks. The starts are assumed to be inside the accumulators (start + patch size <= shape).
+    :param accumulator: Accumulator for the weighted patches (with an optional label axis at the end).
+    :param weights_accumulator: Accumulator for the weights (without the label axis).
+    :param patches: Block of patches (N, w, w, w) or (N, w, w, w, L).
+    :param starts: Start coordinates of the patches (N, 3).
+    :param weights: Weights for the voxels of the patch (applied to all the labels).
+    :return: None.
+    """
+    patch_size = np.array(weights.shape)
+    starts = np.reshape(np.asarray(starts, dtype=np.int64), (-1, len(patch_size)))
+    extra_dims = (1,) * (patches.ndim - 1 - weights.ndim)
+    label_weights = weights.reshape(weights.shape + extra_dims)
+    phases, phase_idx = np.unique(starts % patch_size, axis=0, return_inverse=True)
+    for i, phase in enumerate(phases):
+        group = phase_idx == i
+        blocks = tuple(((starts[group] - phase) / patch_size).T)
+        weighted_patches = patches[group]
+        weighted_patches *= label_weights
+        get_phase_blocks(accumulator, phase, patch_size)[blocks] += weighted_patches
+        get_phase_blocks(weights_accumulator, phase, patch_size)[blocks] += weights
+
+
+def get_phase_blocks(accumulator, phase, patch_size):
+    # View (n_x, n_y, n_z, w, w, w, ...) of the accumulator as a grid of patch-sized blocks from the phase.
+    ndim = len(patch_size)
+    n_blocks = (np.array(accumulator.shape[:ndim]) - phase) / patch_size
+    region = accumulator[tuple(map(lambda ini: slice(ini, None), phase))]
+    return as_strided(
+        region,
+        shape=tuple(n_blocks) + tuple(patch_size) + region.shape[ndim:],
+        strides=tuple(np.array(region.strides[:ndim]) * patch_size) + region.strides
+    )
+
+
+def get_gaussian_weights(patch_size, sigma_scale=0.125, datatype=np.float32):
+    weights_1d = map(
+        lambda size: np.exp(-0.5 * ((np.arange(size) - (size - 1) / 2.) / (size * sigma_scale)) ** 2),
+        patch_size
+    )
+    weights = reduce(np.multiply.outer, weights_1d)
+    # We don't want any voxel to be completely ignored at the borders of the image.
+    return np.maximum(weights / weights.max(), 1e-3).astype(datatype)
+
+
+def get_tile_starts(image_shape, patch_size, stride):
+    # The last tile for each dimension is always aligned with the end of the image.
+    starts = map(
+        lambda (im_size, p_size, s): sorted(set(range(0, max(im_size - p_size, 0) + 1, s) + [max(im_size - p_size, 0)])),
+        zip(image_shape, patch_size, stride)
+    )
+    return np.array(list(product(*starts)))
+
+
+def sliding_window_predict(
+        net,
+        image,
+        patch_size,
+        stride=None,
+        batch_size=128,
+        weighting='gaussian',
+        datatype=np.float32
+):
+    """
+    Function to predict a whole volume by tiling it. The tiles are predicted in batches and their
+    probabilities are blended into a single volume with a gaussian (or uniform) weighting.
+    :param net: Network that outputs the probabilities for each voxel of the patch
+     (either (N, w * w * w, L) or (N, w, w, w, L)).
+    :param image: Sequence of volumes (channels) with the same shape.
+    :param patch_size: Size of the tiles (input of the network).
+    :param stride: Stride between tiles (half the patch size by default).
+    :param batch_size: Number of tiles per prediction batch.
+    :param weighting: Weighting of the voxels of each tile ('gaussian' or 'uniform').
+    :param datatype: Data type of the accumulators (np.float16 halves the memory).
+    :return: Probability volume of shape (X, Y, Z, L).
+    """
+    patch_size = tuple(patch_size)
+    stride = tuple(np.maximum(np.array(patch_size) / 2, 1)) if stride is None else tuple(stride)
+    image_shape = np.shape(image[0])
+    starts = get_tile_starts(image_shape, patch_size, stride)
+    half_size = np.array(patch_size) / 2
+    if weighting == 'gaussian':
+        weights = get_gaussian_weights(patch_size, datatype=datatype)
+    else:
+        weights = np.ones(patch_size, dtype=datatype)
+
+    # The accumulators are bigger than the image, in case the image is smaller than the tiles.
+    accumulator_shape = tuple(np.array(image_shape) + patch_size)
+    accumulator = None
+    weights_accumulator = np.zeros(accumulator_shape, dtype=datatype)
+    for ini in range(0, len(starts), batch_size):
+        batch_starts = starts[ini:ini + batch_size]
+        x = get_patches_block(image, batch_starts + half_size, patch_size, datatype=np.float32)
+        pr_maps = net.predict(x, batch_size=batch_size)
+        pr_maps = pr_maps.reshape((len(x),) + patch_size + (-1,)).astype(datatype)
+        if accumulator is None:
+            accumulator = np.zeros(accumulator_shape + pr_maps.shape[-1:], dtype=datatype)
+        blend_patches(accumulator, weights_accumulator, pr_maps, batch_starts, weights)
+
+    image_slices = tuple(map(lambda size: slice(0, size), image_shape))
+    weights_accumulator = np.maximum(weights_accumulator[image_slices], np.finfo(datatype).tiny)
+    return accumulator[image_slices] / weights_accumulator[..., np.newaxis]
+
+
+def tiled_predict(net_builder, image, tile_size, halo):
+    """
+    Function to predict a whole volume with a fully convolutional network using tiles, to bound the
+    memory needed for the activations. Consecutive tiles overlap by twice the halo (receptive field)
+    of the network and only the voxels that have all their context inside the tile are kept.
+    That way the stitched output is the same as the one for the whole volume.
+    :param net_builder: Function that returns the network for a given input shape.
+    :param image: Sequence of volumes (channels) with the same shape.
+    :param tile_size: Size of the tiles (it should be bigger than twice the halo).
+    :param halo: Number of context voxels needed on each side of an output voxel.
+    :return: Probability volume of shape (X, Y, Z, L).
+    """
+    image_shape = np.array(np.shape(image[0]))
+    tile_size = np.minimum(tile_size, image_shape)
+    stride = np.maximum(tile_size - 2 * halo, 1)
+    starts = get_tile_starts(image_shape, tile_size, stride)
+
+    # All the tiles have the same shape, so we only need to build one network.
+    net = net_builder((len(image),) + tuple(tile_size))
+    pr_maps = None
+    for start in starts:
+        tile_slices = tuple(map(lambda (ini, size): slice(ini, ini + size), zip(start, tile_size)))
+        x = np.expand_dims(np.stack(map(lambda channel: channel[tile_slices], image), axis=0), axis=0)
+        pr_tile = net.predict(x, batch_size=1).reshape(tuple(tile_size) + (-1,))
+        if pr_maps is None:
+            pr_maps = np.zeros(tuple(image_shape) + pr_tile.shape[-1:], dtype=np.float32)
+        # The borders of the image are the same for the tile and the whole volume.
+        ini = np.where(start > 0, halo, 0)
+        end = np.where(start + tile_size < image_shape, tile_size - halo, tile_size)
+        in_slices = tuple(map(lambda (ini_i, end_i): slice(ini_i, end_i), zip(ini, end)))
+        out_slices = tuple(map(lambda (ini_i, end_i): slice(ini_i, end_i), zip(start + ini, start + end)))
+        pr_maps[out_slices] = pr_tile[in_slices]
+
+    return pr_maps
+
+
+def dense_ensemble_predict(conv_net, deconv_net, image, centers, patch_size, chunk_size=16, batch_size=1024):
+    """
+    Function to predict the centers of a region with the dense version of the ensemble
+    (see get_brats_dense_ensemble in nets). The convolutional blocks are computed once for each chunk of
+    the region (instead of once per patch) and the deconvolutional paths take the windows of their
+    feature maps for each patch. The output is the same as testing each patch with the ensemble.
+    :param conv_net: Fully convolutional network (feature maps and partial ensemble output).
+    :param deconv_net: Deconvolutional network (rest of the ensemble output).
+    :param image: Sequence of volumes (channels) with the same shape.
+    :param centers: List of center coordinates.
+    :param patch_size: Size of the patches of the ensemble.
+    :param chunk_size: Number of slices (first axis) with centers computed at once (to bound the memory
+     needed for the feature maps).
+    :param batch_size: Number of patches for each pass of the deconvolutional network.
+    :return: Probabilities for each center (N, L).
+    """
+    patch_size = np.array(patch_size)
+    centers = np.reshape(np.asarray(centers, dtype=np.int64), (-1, len(patch_size)))
+    feature_sizes = map(lambda shape: np.array(shape[2:]), deconv_net.input_shape)
+    pr_maps = np.zeros((len(centers), deconv_net.output_shape[-1]), dtype=np.float32)
+    if len(centers) == 0:
+        return pr_maps
+
+    for ini in range(centers[:, 0].min(), centers[:, 0].max() + 1, chunk_size):
+        chunk_idx = np.nonzero((centers[:, 0] >= ini) & (centers[:, 0] < ini + chunk_size))[0]
+        if len(chunk_idx) == 0:
+            continue
+        chunk_centers = centers[chunk_idx]
+        # The region covers all the patches of the chunk (we extract it as one big patch).
+        chunk_ini = chunk_centers.min(axis=0)
+        region_size = chunk_centers.max(axis=0) - chunk_ini + patch_size
+        region_center = chunk_ini - patch_size / 2 + region_size / 2
+        x = get_patches_block(image, [region_center], region_size, datatype=np.float32)
+        outputs = conv_net.predict(x, batch_size=1)
+        feature_maps = map(lambda output: output[0], outputs[:-1])
+        partial = outputs[-1][0]
+
+        # All the maps are indexed by the first voxel of the patch.
+        starts = chunk_centers - chunk_ini
+        for batch_ini in range(0, len(starts), batch_size):
+            batch_starts = starts[batch_ini:batch_ini + batch_size]
+            windows = map(
+                lambda (feature_map, size): get_patches_block(feature_map, batch_starts + size / 2, size),
+                zip(feature_maps, feature_sizes)
+            )
+            logits = partial[(slice(None),) + tuple(batch_starts.T)].T
+            logits += deconv_net.predict(windows, batch_size=batch_size)
+            logits = np.exp(logits - logits.max(axis=1, keepdims=True))
+            pr_maps[chunk_idx[batch_ini:batch_ini + batch_size]] = logits / logits.sum(axis=1, keepdims=True)
+
+    return pr_maps
@@ -1,6 +1,7 @@
+import numpy as np
 from keras import backend as K
 from keras.layers import Conv2D, Conv3D, Conv3DTranspose, AveragePooling2D, Dropout, BatchNormalization
-from keras.layers import Input, Activation, Reshape, Permute, Lambda, Flatten, Dense, concatenate
+from keras.layers import Input, Activation, Reshape, Permute, Lambda, Flatten, Dense, concatenate, add
 from keras.models import Model
 from keras.applications.vgg16 import VGG16
 from layers import ScalingLayer, ThresholdingLayer
@@ -11,7 +12,12 @@ def dsc_loss(y_true, y_pred):
     return 1 - 2 * dsc_class[0]
 
 
-def get_brats_unet(input_shape, filters_list, kernel_size_list, nlabels, drop=0.2):
+def get_seg_loss(sparse=False):
+    # With sparse labels the targets are the (uint8) label indices instead of one-hot vectors.
+    return 'sparse_categorical_crossentropy' if sparse else 'categorical_crossentropy'
+
+
+def get_brats_unet(input_shape, filters_list, kernel_size_list, nlabels, drop=0.2, sparse=False):
     inputs = Input(shape=input_shape, name='seg_inputs')
 
     curr_tensor = inputs
@@ -54,14 +60,39 @@ def get_brats_unet(input_shape, filters_list, kernel_size_list, nlabels, drop=0.
 
     net.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
 
     return net
 
 
-def get_brats_roinet(input_shape, filters_list, kernel_size_list, nlabels=2, drop=0.2):
+def get_unet_halo(kernel_size_list):
+    # Each valid convolution (and its transposed counterpart) needs (k - 1) voxels of context.
+    return sum(map(lambda k: k - 1, kernel_size_list))
+
+
+def get_unet_tile_width(
+        memory_budget, n_channels, filters_list, kernel_size_list, nlabels, dtype_bytes=4, min_stride=16
+):
+    # Rough (pessimistic) estimate of the activations alive per voxel: the inputs, the convolutional and
+    # deconvolutional outputs, the concatenated skip connections and the final labels (dense, reshape, softmax).
+    voxel_bytes = dtype_bytes * (n_channels + 4 * sum(filters_list) + 3 * nlabels)
+    tile_width = int((memory_budget / float(voxel_bytes)) ** (1. / 3))
+    # The tile needs to be bigger than the halo on both sides for the stitching to be exact, and the stride
+    # (tile - 2 * halo) has to be big enough or we would need one prediction for (almost) each voxel.
+    min_width = 2 * get_unet_halo(kernel_size_list) + min_stride
+    if tile_width < min_width:
+        raise ValueError(
+            'A memory budget of %.1f MB only allows tiles of %d voxels (tiles of at least %d voxels '
+            'need a budget of %.1f MB)' % (
+                memory_budget / 1024. ** 2, tile_width, min_width, voxel_bytes * min_width ** 3 / 1024. ** 2
+            )
+        )
+    return tile_width
+
+
+def get_brats_roinet(input_shape, filters_list, kernel_size_list, nlabels=2, drop=0.2, sparse=False):
     # Input
     inputs = Input(shape=input_shape, name='seg_inputs')
 
@@ -116,14 +147,14 @@ def get_brats_roinet(input_shape, filters_list, kernel_size_list, nlabels=2, dro
 
     net.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
 
     return net
 
 
-def get_brats_invunet(input_shape, filters_list, kernel_size_list, nlabels, drop=0.2):
+def get_brats_invunet(input_shape, filters_list, kernel_size_list, nlabels, drop=0.2, sparse=False):
     inputs = Input(shape=input_shape, name='seg_inputs')
 
     curr_tensor = inputs
@@ -166,14 +197,14 @@ def get_brats_invunet(input_shape, filters_list, kernel_size_list, nlabels, drop
 
     net.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
 
     return net
 
 
-def get_brats_cnn(n_channels, filters_list, kernel_size_list, nlabels, dense_size, drop=0.2):
+def get_brats_cnn(n_channels, filters_list, kernel_size_list, nlabels, dense_size, drop=0.2, sparse=False):
     # Init
     n_blocks = len(filters_list)
     input_shape_d = (n_channels, 3, 3, 3)
@@ -222,14 +253,14 @@ def get_brats_cnn(n_channels, filters_list, kernel_size_list, nlabels, dense_siz
 
     net.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
 
     return net
 
 
-def get_brats_nets(n_channels, filters_list, kernel_size_list, nlabels, dense_size, drop=0.5):
+def get_brats_nets(n_channels, filters_list, kernel_size_list, nlabels, dense_size, drop=0.5, sparse=False):
     # Init
     n_blocks = len(filters_list)
     input_shape = (n_channels,) + (n_blocks * 2 + 3,) * 3
@@ -340,25 +371,25 @@ def get_brats_nets(n_channels, filters_list, kernel_size_list, nlabels, dense_si
     unet = Model(inputs=inputs, outputs=unet_out)
     unet.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
     cnn = Model(inputs=inputs, outputs=cnn_out)
     cnn.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
     fcnn = Model(inputs=inputs, outputs=fcnn_out)
     fcnn.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
     ucnn = Model(inputs=inputs, outputs=ucnn_out)
     ucnn.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
 
@@ -368,14 +399,14 @@ def get_brats_nets(n_channels, filters_list, kernel_size_list, nlabels, dense_si
     nets = Model(inputs=inputs, outputs=nets_outputs)
     nets.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy'],
         loss_weights=[2, 2, 2, 2]
     )
     return nets, unet, cnn, fcnn, ucnn
 
 
-def get_brats_ensemble(n_channels, n_blocks, unet, cnn, fcnn, ucnn, nlabels):
+def get_brats_ensemble(n_channels, n_blocks, unet, cnn, fcnn, ucnn, nlabels, sparse=False):
     # Init
     input_shape = (n_channels,) + (n_blocks * 2 + 3,) * 3
 
@@ -387,7 +418,7 @@ def get_brats_ensemble(n_channels, n_blocks, unet, cnn, fcnn, ucnn, nlabels):
     unet.trainable = False
     unet.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
 
@@ -396,7 +427,7 @@ def get_brats_ensemble(n_channels, n_blocks, unet, cnn, fcnn, ucnn, nlabels):
     cnn.trainable = False
     cnn.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
 
@@ -405,7 +436,7 @@ def get_brats_ensemble(n_channels, n_blocks, unet, cnn, fcnn, ucnn, nlabels):
     fcnn.trainable = False
     fcnn.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
 
@@ -414,7 +445,7 @@ def get_brats_ensemble(n_channels, n_blocks, unet, cnn, fcnn, ucnn, nlabels):
     ucnn.trainable = False
     ucnn.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
 
@@ -430,29 +461,53 @@ def get_brats_ensemble(n_channels, n_blocks, unet, cnn, fcnn, ucnn, nlabels):
     ensemble = Model(inputs=inputs, outputs=ensemble_out)
     ensemble.compile(
         optimizer='adadelta',
-        loss='categorical_crossentropy',
+        loss=get_seg_loss(sparse),
         metrics=['accuracy']
     )
 
     return ensemble
 
 
-def get_brats_survival(thresholds=[300, 450], n_slices=20, n_features=4, dense_size=256, dropout=0.1):
+def get_brats_survival_base():
+    # Frozen VGG model used for each slice of the survival network. Its output for a (224, 224, 3)
+    # slice is a (7, 7, 512) feature tensor.
+    base_model = VGG16(weights='imagenet', include_top=False, input_shape=(224, 224, 3))
+    for layer in base_model.layers:
+        layer.trainable = False
+    return base_model
+
+
+def get_brats_survival(
+        thresholds=[300, 450],
+        n_slices=20,
+        n_features=4,
+        dense_size=256,
+        dropout=0.1,
+        cached_features=False
+):
     # Input (3D volume of X*X*S) + other features (age, tumor volumes and resection status?)
     # This volume should be split into S inputs that will be passed to S VGG models.
-    vol_input = Input(shape=(224, 224, n_slices, 3), name='vol_input')
-    slice_inputs = map(lambda i: Lambda(lambda l: l[:, :, :, i, :])(vol_input), range(n_slices))
+    # The VGG model is frozen, so its outputs can also be precomputed. In that case, the input
+    # is already the (S, 7, 7, 512) tensor with the VGG features for each slice.
+    if cached_features:
+        vol_input = Input(shape=(n_slices, 7, 7, 512), name='vol_input')
+        slice_inputs = map(lambda i: Lambda(lambda l, i=i: l[:, i])(vol_input), range(n_slices))
+    else:
+        vol_input = Input(shape=(224, 224, n_slices, 3), name='vol_input')
+        slice_inputs = map(lambda i: Lambda(lambda l: l[:, :, :, i, :])(vol_input), range(n_slices))
 
     feature_input = Input(shape=(n_features, ), name='feat_input')
     inputs = [vol_input, feature_input]
 
     # VGG init
-    base_model = VGG16(weights='imagenet', include_top=False)
-    for layer in base_model.layers:
-        layer.trainable = False
+    if cached_features:
+        base_out = slice_inputs
+    else:
+        base_model = get_brats_survival_base()
+        base_out = map(base_model, slice_inputs)
 
     # vgg_out = map(base_model, slice_inputs)
-    vgg_out = map(BatchNormalization(), map(base_model, slice_inputs))
+    vgg_out = map(BatchNormalization(), base_out)
 
     # - Conv2D
     # vgg_fcc1 = Conv2D(512, (1, 1), activation='relu')
@@ -500,3 +555,262 @@ def get_brats_survival(thresholds=[300, 450], n_slices=20, n_features=4, dense_s
     )
 
     return survival_net
+
+
+def get_ensemble_parts(ensemble):
+    # The networks inside the ensemble are found by the name of their outputs (see get_brats_nets).
+    sub_nets = {l.output_names[0]: l for l in ensemble.layers if isinstance(l, Model)}
+    nets = map(lambda name: sub_nets[name], ['unet_seg', 'cnn_seg', 'fcnn_seg', 'ucnn_seg'])
+    unet, cnn, fcnn, ucnn = nets
+    ensemble_dense = get_dense_layers(ensemble)[0]
+    branch_deconvs = map(lambda net: [l for l in net.layers if type(l) is Conv3DTranspose], [unet, ucnn])
+    return {
+        'cnn_dense': get_dense_layers(cnn),
+        'ucnn_dense': get_dense_layers(ucnn)[0],
+        'ensemble_dense': ensemble_dense,
+        'convs': map(lambda net: [l for l in net.layers if type(l) is Conv3D], nets),
+        'deconvs': branch_deconvs,
+        'n_blocks': len(branch_deconvs[0]),
+        'nlabels': ensemble_dense.units,
+    }
+
+
+def get_dense_layers(net):
+    return [l for l in net.layers if type(l) is Dense]
+
+
+def fold_linear_layers(layers):
+    # Two consecutive linear layers (dense layers or 1x1x1 convolutions) are the same as one.
+    (w1, b1), (w2, b2) = map(lambda l: l.get_weights(), layers)
+    w1 = w1.reshape((-1, w1.shape[-1]))
+    w2 = w2.reshape((-1, w2.shape[-1]))
+    return w1.dot(w2), b1.dot(w2) + b2
+
+
+def copy_layer(layer, weights, layer_weights):
+    # The weights are copied once the graph is created.
+    layer_weights.append((layer, weights))
+    return layer
+
+
+def copy_conv(conv, layer_weights):
+    new_conv = type(conv)(
+        conv.filters,
+        kernel_size=conv.kernel_size,
+        activation=conv.activation,
+        data_format='channels_first'
+    )
+    return copy_layer(new_conv, conv.get_weights(), layer_weights)
+
+
+def copy_deconv_path(tensor, skip_list, deconvs, dense, layer_weights):
+    tensor = copy_conv(deconvs[0], layer_weights)(tensor)
+    for prev_tensor, deconv in zip(skip_list[-2::-1], deconvs[1:]):
+        tensor = copy_conv(deconv, layer_weights)(concatenate([prev_tensor, tensor], axis=1))
+    return copy_conv(dense, layer_weights)(tensor)
+
+
+def get_brats_fused_ensemble(ensemble):
+    """
+    Function to create an inference only version of the ensemble from get_brats_ensemble. All the
+    networks are flattened into a single graph (without the dropout layers) and their weights copied.
+    The first convolution is shared by all the networks (they all take the same input), so it's fused
+    into one convolution. Consecutive linear layers (the dense layers from the cnn and the 1x1x1
+    convolutions from the fcnn) are also folded into one layer.
+    :param ensemble: Trained ensemble network.
+    :return: Ensemble network for testing.
+    """
+    # Init
+    parts = get_ensemble_parts(ensemble)
+    input_shape = ensemble.input_shape[1:]
+    branch_convs = parts['convs']
+    branch_deconvs = parts['deconvs']
+    n_blocks = parts['n_blocks']
+    nlabels = parts['nlabels']
+    layer_weights = list()
+
+    inputs = Input(shape=input_shape, name='seg_inputs')
+
+    # > Shared first block
+    first_convs = map(lambda convs: convs[0], branch_convs)
+    first_filters = map(lambda conv: conv.filters, first_convs)
+    first_conv = copy_layer(
+        Conv3D(
+            sum(first_filters),
+            kernel_size=first_convs[0].kernel_size,
+            activation='relu',
+            data_format='channels_first'
+        ),
+        [
+            np.concatenate(map(lambda conv: conv.get_weights()[0], first_convs), axis=-1),
+            np.concatenate(map(lambda conv: conv.get_weights()[1], first_convs), axis=-1)
+        ],
+        layer_weights
+    )
+    first_tensor = first_conv(inputs)
+    branch_ini = np.cumsum([0] + first_filters)
+    first_shape = K.int_shape(first_tensor)[2:]
+    tensors = map(
+        lambda (ini, end): Lambda(
+            lambda x, ini=ini, end=end: x[:, ini:end],
+            output_shape=(end - ini,) + first_shape
+        )(first_tensor),
+        zip(branch_ini[:-1], branch_ini[1:])
+    )
+
+    # > Rest of the convolutional blocks
+    unet_list = [tensors[0]]
+    ucnn_list = [tensors[3]]
+    for i in range(1, n_blocks):
+        tensors = map(lambda (tensor, convs): copy_conv(convs[i], layer_weights)(tensor), zip(tensors, branch_convs))
+        unet_list.append(tensors[0])
+        ucnn_list.append(tensors[3])
+    unet_tensor, cnn_tensor, fcnn_tensor, ucnn_tensor = tensors
+
+    # > Convolutional only stuff
+    # CNN (both dense layers are linear)
+    cnn_dense = copy_layer(Dense(nlabels), fold_linear_layers(parts['cnn_dense']), layer_weights)
+    cnn_tensor = cnn_dense(Flatten()(cnn_tensor))
+    # FCNN (both 1x1x1 convolutions are linear)
+    fcnn_kernel, fcnn_bias = fold_linear_layers(branch_convs[2][n_blocks:])
+    fcnn_conv = copy_layer(
+        Conv3D(nlabels, kernel_size=(1, 1, 1), data_format='channels_first'),
+        [fcnn_kernel.reshape((1, 1, 1) + fcnn_kernel.shape), fcnn_bias],
+        layer_weights
+    )
+    fcnn_tensor = fcnn_conv(fcnn_tensor)
+    fcnn_tensor = Permute((2, 1))(Reshape((nlabels, -1))(fcnn_tensor))
+
+    # > U-stuff
+    unet_tensor = copy_deconv_path(
+        unet_tensor, unet_list, branch_deconvs[0], branch_convs[0][n_blocks], layer_weights
+    )
+    unet_tensor = Permute((2, 1))(Reshape((nlabels, -1))(unet_tensor))
+
+    ucnn_tensor = copy_deconv_path(
+        ucnn_tensor, ucnn_list, branch_deconvs[1], branch_convs[3][n_blocks], layer_weights
+    )
+    ucnn_dense = copy_layer(Dense(nlabels), parts['ucnn_dense'].get_weights(), layer_weights)
+    ucnn_tensor = ucnn_dense(Flatten()(ucnn_tensor))
+
+    unet_out = Activation('softmax')(unet_tensor)
+    cnn_out = Activation('softmax')(cnn_tensor)
+    fcnn_out = Activation('softmax')(fcnn_tensor)
+    ucnn_out = Activation('softmax')(ucnn_tensor)
+
+    # > Ensemble
+    ensemble_tensor = concatenate([Flatten()(unet_out), cnn_out, Flatten()(fcnn_out), ucnn_out])
+    ensemble_dense = copy_layer(Dense(nlabels), parts['ensemble_dense'].get_weights(), layer_weights)
+    ensemble_out = Activation('softmax', name='unet_seg')(ensemble_dense(ensemble_tensor))
+
+    fused_ensemble = Model(inputs=inputs, outputs=ensemble_out)
+    for layer, weights in layer_weights:
+        layer.set_weights(weights)
+
+    return fused_ensemble
+
+
+def get_brats_dense_ensemble(ensemble):
+    """
+    Function to create a dense version of the ensemble from get_brats_ensemble, to test all the centers
+    of a region without recomputing the convolutions for overlapping patches. It returns two networks:
+    - A fully convolutional network (any input size) that computes the convolutional blocks of all the
+     networks once for the whole region. Its outputs are the feature maps needed by the deconvolutional
+     paths (one per block for the unet and the ucnn) and the (pre-softmax) contribution of the cnn and
+     the fcnn to the ensemble, where their dense layers are replaced by the equivalent convolutions.
+    - A network for the deconvolutional paths of the unet and the ucnn. The transposed convolutions
+     only see the features inside the patch, so their output changes with the patch limits and can't be
+     computed densely. This network takes the windows of the feature maps for each patch instead and
+     returns their (pre-softmax) contribution to the ensemble.
+    The output of the ensemble for a patch is the softmax of the sum of both contributions
+    (see dense_ensemble_predict in data_creation).
+    :param ensemble: Trained ensemble network.
+    :return: Fully convolutional network and deconvolutional network.
+    """
+    # Init
+    parts = get_ensemble_parts(ensemble)
+    n_channels = ensemble.input_shape[1]
+    patch_size = ensemble.input_shape[2:]
+    branch_convs = parts['convs']
+    branch_deconvs = parts['deconvs']
+    n_blocks = parts['n_blocks']
+    nlabels = parts['nlabels']
+    layer_weights = list()
+    feature_shapes = map(lambda conv: conv.output_shape[1:], branch_convs[0][:n_blocks])
+
+    # The ensemble dense layer is split by network (same order as the concatenation).
+    ensemble_kernel, ensemble_bias = parts['ensemble_dense'].get_weights()
+    unet_kernel, cnn_kernel, fcnn_kernel, ucnn_kernel = np.split(
+        ensemble_kernel,
+        np.cumsum([np.prod(patch_size) * nlabels, nlabels, np.prod(feature_shapes[-1][1:]) * nlabels])
+    )
+
+    # > Convolutional blocks
+    inputs = Input(shape=(n_channels, None, None, None), name='seg_inputs')
+    tensors = [inputs] * 4
+    unet_list = list()
+    ucnn_list = list()
+    for i in range(n_blocks):
+        tensors = map(lambda (tensor, convs): copy_conv(convs[i], layer_weights)(tensor), zip(tensors, branch_convs))
+        unet_list.append(tensors[0])
+        ucnn_list.append(tensors[3])
+    cnn_tensor, fcnn_tensor = tensors[1:3]
+
+    # > Convolutional only stuff
+    # CNN (the folded dense layers are a convolution with the size of the last feature map)
+    cnn_kernel_dense, cnn_bias = fold_linear_layers(parts['cnn_dense'])
+    cnn_kernel_conv = np.transpose(cnn_kernel_dense.reshape(feature_shapes[-1] + (nlabels,)), (1, 2, 3, 0, 4))
+    cnn_conv = copy_layer(
+        Conv3D(nlabels, kernel_size=cnn_kernel_conv.shape[:3], data_format='channels_first'),
+        [cnn_kernel_conv, cnn_bias],
+        layer_weights
+    )
+    cnn_tensor = Lambda(lambda x: K.softmax(x, axis=1))(cnn_conv(cnn_tensor))
+    cnn_ensemble = copy_layer(
+        Conv3D(nlabels, kernel_size=(1, 1, 1), data_format='channels_first'),
+        [cnn_kernel.reshape((1, 1, 1, nlabels, nlabels)), ensemble_bias],
+        layer_weights
+    )
+    cnn_tensor = cnn_ensemble(cnn_tensor)
+    # FCNN (the ensemble dense layer is a convolution over the probabilities of the last feature map)
+    fcnn_kernel_dense, fcnn_bias = fold_linear_layers(branch_convs[2][n_blocks:])
+    fcnn_conv = copy_layer(
+        Conv3D(nlabels, kernel_size=(1, 1, 1), data_format='channels_first'),
+        [fcnn_kernel_dense.reshape((1, 1, 1) + fcnn_kernel_dense.shape), fcnn_bias],
+        layer_weights
+    )
+    fcnn_tensor = Lambda(lambda x: K.softmax(x, axis=1))(fcnn_conv(fcnn_tensor))
+    fcnn_kernel = fcnn_kernel.reshape(feature_shapes[-1][1:] + (nlabels, nlabels))
+    fcnn_ensemble = copy_layer(
+        Conv3D(nlabels, kernel_size=fcnn_kernel.shape[:3], use_bias=False, data_format='channels_first'),
+        [fcnn_kernel],
+        layer_weights
+    )
+    fcnn_tensor = fcnn_ensemble(fcnn_tensor)
+
+    conv_net = Model(inputs=inputs, outputs=unet_list + ucnn_list + [add([cnn_tensor, fcnn_tensor])])
+
+    # > U-stuff
+    unet_inputs = map(lambda shape: Input(shape=shape), feature_shapes)
+    unet_tensor = copy_deconv_path(
+        unet_inputs[-1], unet_inputs, branch_deconvs[0], branch_convs[0][n_blocks], layer_weights
+    )
+    unet_tensor = Activation('softmax')(Permute((2, 1))(Reshape((nlabels, -1))(unet_tensor)))
+    unet_ensemble = copy_layer(Dense(nlabels, use_bias=False), [unet_kernel], layer_weights)
+    unet_tensor = unet_ensemble(Flatten()(unet_tensor))
+
+    ucnn_inputs = map(lambda shape: Input(shape=shape), feature_shapes)
+    ucnn_tensor = copy_deconv_path(
+        ucnn_inputs[-1], ucnn_inputs, branch_deconvs[1], branch_convs[3][n_blocks], layer_weights
+    )
+    ucnn_dense = copy_layer(Dense(nlabels), parts['ucnn_dense'].get_weights(), layer_weights)
+    ucnn_tensor = Activation('softmax')(ucnn_dense(Flatten()(ucnn_tensor)))
+    ucnn_ensemble = copy_layer(Dense(nlabels, use_bias=False), [ucnn_kernel], layer_weights)
+    ucnn_tensor = ucnn_ensemble(ucnn_tensor)
+
+    deconv_net = Model(inputs=unet_inputs + ucnn_inputs, outputs=add([unet_tensor, ucnn_tensor]))
+
+    for layer, weights in layer_weights:
+        layer.set_weights(weights)
+
+    return conv_net, deconv_net
@@ -1,57 +1,63 @@
 #!/usr/bin/python
 from __future__ import print_function
+import argparse
 import os
-from time import strftime
+import socket
+from Queue import Queue
+from threading import Thread
+from time import strftime, sleep, time
 import numpy as np
 from nibabel import load as load_nii
 from utils import color_codes, get_biggest_region
-from data_creation import get_mask_blocks, get_data, load_images
-from nets import get_brats_unet, get_brats_ensemble, get_brats_nets
+from data_creation import get_mask_blocks, get_data, load_images, tiled_predict, dense_ensemble_predict
+from data_creation import set_volume_cache_size
+from nets import get_brats_unet, get_brats_ensemble, get_brats_nets, get_unet_halo, get_unet_tile_width
+from nets import get_brats_fused_ensemble, get_brats_dense_ensemble
 
 
-def main():
-    # Init
-    c = color_codes()
-    nlabels = 5
-
-    # Prepare the names
-    flair_name = '/data/flair.nii.gz'
-    t2_name = '/data/t2.nii.gz'
-    t1_name = '/data/t1.nii.gz'
-    t1ce_name = '/data/t1ce.nii.gz'
-
-    image_names = [flair_name, t2_name, t1_name, t1ce_name]
-
-    ''' Unet stuff '''
-    # Data loading
-    x = np.expand_dims(np.stack(load_images(image_names), axis=0), axis=0)
+def parse_inputs():
+    parser = argparse.ArgumentParser(description='Test the BRATS 2018 pipeline on a single patient.')
+    parser.add_argument(
+        '-m', '--memory-budget',
+        dest='memory_budget', type=int, default=None,
+        help='Maximum memory (in MB) for the unet activations (tiled testing)'
+    )
+    parser.add_argument(
+        '-w', '--watch',
+        dest='watch_dir', default=None,
+        help='Folder to watch for new patient folders (long-running mode)'
+    )
+    parser.add_argument(
+        '-s', '--socket',
+        dest='socket_name', default=None,
+        help='Local (unix) socket that receives patient folders, one per line (long-running mode)'
+    )
+    parser.add_argument(
+        '--settle-time',
+        dest='settle_time', type=float, default=5,
+        help='Seconds without changes before a watched patient folder is processed'
+    )
+    parser.add_argument(
+        '--volume-cache',
+        dest='volume_cache', type=int, default=512,
+        help='Memory budget (in MB) for the decoded volumes cache (long-running mode)'
+    )
+    parser.add_argument(
+        '-d', '--dense-ensemble',
+        action='store_true', dest='dense_ensemble', default=False,
+        help='Test the ensemble densely (the convolutions are shared by overlapping patches)'
+    )
+    return vars(parser.parse_args())
 
-    # Network loading and testing
-    print('%s[%s] %sTesting the Unet%s' % (c['c'], strftime("%H:%M:%S"), c['g'], c['nc']))
-    net = get_brats_unet(x.shape[1:], [32] * 5, [3] * 5, nlabels)
-    net.load_weights('/usr/local/models/brats18-unet.hdf5')
-    pr_maps = net.predict(x)
-    image = np.argmax(pr_maps, axis=-1).reshape(x.shape[2:])
-    mask = get_biggest_region(image).astype(np.bool)
 
-    ''' Ensemble stuff '''
-    # Init
-    image = np.zeros_like(mask, dtype=np.int8)
+def get_patient_names(path):
+    return map(lambda name: os.path.join(path, name), ['flair.nii.gz', 't2.nii.gz', 't1.nii.gz', 't1ce.nii.gz'])
 
-    # Data loading
-    test_centers = get_mask_blocks(mask)
-    x = get_data(
-        image_names=[image_names],
-        list_of_centers=[test_centers],
-        patch_size=(9,) * 3,
-        verbose=True,
-    )
-    print('%s- Concatenating the data x' % ' '.join([''] * 12))
-    x = np.concatenate(x)
 
-    # Networks loading
+def load_networks(nlabels, dense=False):
+    # The unet depends on the image shape, so we only store the ones we already built (one per shape).
     nets, unet, cnn, fcnn, ucnn = get_brats_nets(
-        n_channels=len(image_names),
+        n_channels=4,
         filters_list=[32] * 3,
         kernel_size_list=[3] * 3,
         nlabels=nlabels,
@@ -59,7 +65,7 @@ def main():
     )
 
     ensemble = get_brats_ensemble(
-        n_channels=len(image_names),
+        n_channels=4,
         n_blocks=3,
         unet=unet,
         cnn=cnn,
@@ -71,17 +77,183 @@ def main():
     nets.load_weights('/usr/local/models/brats18-nets.hdf5')
     ensemble.load_weights('/usr/local/models/brats18-ensemble.hdf5')
 
-    # Network testing and results saving
-    pr_maps = ensemble.predict(x)
+    if dense:
+        return {'unet': dict(), 'ensemble': get_brats_dense_ensemble(ensemble)}
+    else:
+        return {'unet': dict(), 'ensemble': get_brats_fused_ensemble(ensemble)}
+
+
+def get_unet(networks, input_shape, nlabels):
+    input_shape = tuple(input_shape)
+    try:
+        net = networks['unet'][input_shape]
+    except KeyError:
+        net = get_brats_unet(input_shape, [32] * 5, [3] * 5, nlabels)
+        net.load_weights('/usr/local/models/brats18-unet.hdf5')
+        networks['unet'][input_shape] = net
+    return net
+
+
+def segment_patient(networks, image_names, images, options, nlabels):
+    c = color_codes()
+
+    ''' Unet stuff '''
+    # Network testing
+    print('%s[%s] %sTesting the Unet%s' % (c['c'], strftime("%H:%M:%S"), c['g'], c['nc']))
+    if options['memory_budget'] is not None:
+        tile_width = get_unet_tile_width(
+            options['memory_budget'] * 1024 ** 2, len(images), [32] * 5, [3] * 5, nlabels
+        )
+        pr_maps = tiled_predict(
+            lambda input_shape: get_unet(networks, input_shape, nlabels),
+            images,
+            (tile_width,) * 3,
+            get_unet_halo([3] * 5)
+        )
+        image = np.argmax(pr_maps, axis=-1)
+    else:
+        x = np.expand_dims(np.stack(images, axis=0), axis=0)
+        net = get_unet(networks, x.shape[1:], nlabels)
+        pr_maps = net.predict(x)
+        image = np.argmax(pr_maps, axis=-1).reshape(x.shape[2:])
+    mask = get_biggest_region(image).astype(np.bool)
+
+    ''' Ensemble stuff '''
+    # Init
+    image = np.zeros_like(mask, dtype=np.int8)
+    if not mask.any():
+        print('%s- No tumor found by the Unet' % ' '.join([''] * 12))
+        return image
+
+    # Data loading (the volumes are already in the volume cache) and network testing
+    test_centers = get_mask_blocks(mask)
+    if options['dense_ensemble']:
+        conv_net, deconv_net = networks['ensemble']
+        pr_maps = dense_ensemble_predict(conv_net, deconv_net, images, test_centers, (9,) * 3)
+    else:
+        x = get_data(
+            image_names=[image_names],
+            list_of_centers=[test_centers],
+            patch_size=(9,) * 3,
+            verbose=True,
+        )
+        print('%s- Concatenating the data x' % ' '.join([''] * 12))
+        x = np.concatenate(x)
+        pr_maps = networks['ensemble'].predict(x)
     [x, y, z] = np.stack(test_centers, axis=1)
     image[x, y, z] = np.argmax(pr_maps, axis=1).astype(dtype=np.int8)
 
-    if not os.path.isdir('/data/results'):
-        os.mkdir('/data/results')
-    roi_nii = load_nii(flair_name)
+    return image
+
+
+def save_segmentation(image, reference_name, path):
+    results_path = os.path.join(path, 'results')
+    if not os.path.isdir(results_path):
+        os.mkdir(results_path)
+    roi_nii = load_nii(reference_name)
     roi_nii.get_data()[:] = image
-    roi_nii.to_filename('/data/results/tumor_NVICOROB_class.nii.gz')
+    roi_nii.to_filename(os.path.join(results_path, 'tumor_NVICOROB_class.nii.gz'))
+
+
+def watch_patients(path, patient_queue, settle_time, period=1):
+    # A patient folder is ready when all the images are there and nothing changed for a while
+    # (to avoid reading files that are still being copied).
+    processed = set()
+    while True:
+        for folder in sorted(os.listdir(path)):
+            patient_path = os.path.join(path, folder)
+            image_names = get_patient_names(patient_path)
+            if patient_path in processed or not all(map(os.path.isfile, image_names)):
+                continue
+            if time() - max(map(os.path.getmtime, [patient_path] + image_names)) > settle_time:
+                processed.add(patient_path)
+                patient_queue.put(patient_path)
+        sleep(period)
+
+
+def listen_patients(socket_name, patient_queue):
+    if os.path.exists(socket_name):
+        os.remove(socket_name)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_name)
+    server.listen(5)
+    while True:
+        connection, _ = server.accept()
+        try:
+            for line in connection.makefile('r'):
+                if line.strip():
+                    patient_queue.put(line.strip())
+        finally:
+            connection.close()
+
+
+def load_patients(patient_queue, data_queue):
+    # The images for the next patient are decoded while the current one is being segmented
+    # (the data queue only holds one patient ahead).
+    while True:
+        patient_path = patient_queue.get()
+        image_names = get_patient_names(patient_path)
+        # A broken patient (missing or corrupted files) should not stop the service.
+        try:
+            images = load_images(image_names)
+        except Exception as e:
+            print('Patient %s could not be loaded (%s: %s)' % (patient_path, type(e).__name__, e))
+            continue
+        data_queue.put((patient_path, image_names, images))
+
+
+def serve(options, nlabels):
+    c = color_codes()
+    # Patients are only seen once, so the cache only needs to hold the current patient and the next one.
+    set_volume_cache_size(options['volume_cache'] * 1024 ** 2)
+    print('%s[%s] %sLoading the networks%s' % (c['c'], strftime("%H:%M:%S"), c['g'], c['nc']))
+    networks = load_networks(nlabels, options['dense_ensemble'])
+
+    patient_queue = Queue()
+    data_queue = Queue(maxsize=1)
+    sources = list()
+    if options['watch_dir'] is not None:
+        sources.append(Thread(
+            target=watch_patients, args=(options['watch_dir'], patient_queue, options['settle_time'])
+        ))
+    if options['socket_name'] is not None:
+        sources.append(Thread(target=listen_patients, args=(options['socket_name'], patient_queue)))
+    sources.append(Thread(target=load_patients, args=(patient_queue, data_queue)))
+    for thread in sources:
+        thread.daemon = True
+        thread.start()
+
+    print('%s[%s] %sWaiting for patients%s' % (c['c'], strftime("%H:%M:%S"), c['g'], c['nc']))
+    while True:
+        patient_path, image_names, images = data_queue.get()
+        print('%s[%s] %sPatient %s%s%s' % (
+            c['c'], strftime("%H:%M:%S"), c['g'], c['b'], patient_path, c['nc']
+        ))
+        try:
+            image = segment_patient(networks, image_names, images, options, nlabels)
+            save_segmentation(image, image_names[0], patient_path)
+        except Exception as e:
+            print('%s[%s] %sPatient %s failed (%s: %s)%s' % (
+                c['c'], strftime("%H:%M:%S"), c['r'], patient_path, type(e).__name__, e, c['nc']
+            ))
+
+
+def main():
+    # Init
+    options = parse_inputs()
+    nlabels = 5
+
+    if options['watch_dir'] is not None or options['socket_name'] is not None:
+        serve(options, nlabels)
+    else:
+        # Prepare the names
+        image_names = get_patient_names('/data')
+
+        # Networks loading, testing and results saving
+        networks = load_networks(nlabels, options['dense_ensemble'])
+        image = segment_patient(networks, image_names, load_images(image_names), options, nlabels)
+        save_segmentation(image, image_names[0], '/data')
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,16 +1,29 @@
 from __future__ import print_function
 import argparse
 import os
+import sys
 import csv
-from time import strftime
+import hashlib
+import subprocess
+import atexit
+from distutils.spawn import find_executable
+from multiprocessing import cpu_count
+from time import strftime, sleep
 import numpy as np
 from keras.callbacks import ModelCheckpoint, EarlyStopping
 from nibabel import load as load_nii
-from utils import color_codes, get_biggest_region
+from utils import color_codes, get_biggest_region, set_profiling, profile_stage, save_profile
 from data_creation import get_mask_centers, get_bounding_centers, get_mask_blocks
 from data_creation import get_patch_labels, get_data, get_labels, load_images, get_reshaped_data
+from data_creation import set_volume_cache_size, load_volume, preprocess_patients, PatchSequence, set_volume_store
+from data_creation import set_loader_workers, sliding_window_predict, tiled_predict, dense_ensemble_predict
+from data_creation import FeatureStore, get_patient_catalog, get_cache_path, set_catalog_store
+from data_creation import get_writable_path, get_dataset_name
 from data_manipulation.metrics import dsc_seg
 from nets import get_brats_unet, get_brats_invunet, get_brats_ensemble, get_brats_nets, get_brats_survival
+from nets import get_brats_survival_base
+from nets import get_unet_halo, get_unet_tile_width, get_brats_fused_ensemble, get_brats_dense_ensemble
+import tensorflow as tf
 from keras import backend as K
 from keras.applications.resnet50 import preprocess_input
 
@@ -183,6 +196,86 @@ def parse_inputs():
         dest='n_folds', type=int, default=5,
         help='Number of folds for the cross-validation'
     )
+    parser.add_argument(
+        '--volume-cache',
+        dest='volume_cache', type=int, default=4096,
+        help='Memory budget (in MB) for the decoded volumes cache'
+    )
+    parser.add_argument(
+        '--volume-store',
+        dest='volume_store', default=None,
+        help='Folder for the preprocessed (memory-mapped) patient volumes'
+    )
+    parser.add_argument(
+        '--catalog-store',
+        dest='catalog_store', default=None,
+        help='Folder for the patient catalogs (a hidden folder inside each dataset folder by default)'
+    )
+    parser.add_argument(
+        '--streaming',
+        action='store_true', dest='streaming', default=False,
+        help='Extract the training patches for each batch on the fly (it uses the volume store)'
+    )
+    parser.add_argument(
+        '--queue-size',
+        dest='queue_size', type=int, default=10,
+        help='Maximum number of batches prefetched when streaming'
+    )
+    parser.add_argument(
+        '--loader-workers',
+        dest='loader_workers', type=int, default=1,
+        help='Number of processes used to load the patients (it uses the volume store)'
+    )
+    parser.add_argument(
+        '--sliding-window',
+        dest='sliding_stride', type=int, default=None,
+        help='Stride for the tiled (sliding window) testing of the unet (whole volume by default)'
+    )
+    parser.add_argument(
+        '--blending',
+        dest='blending', default='gaussian', choices=['gaussian', 'uniform'],
+        help='Weighting of the overlapping tiles for the sliding window testing'
+    )
+    parser.add_argument(
+        '--float16-accumulator',
+        action='store_true', dest='float16_accumulator', default=False,
+        help='Use half precision to blend the sliding window tiles'
+    )
+    parser.add_argument(
+        '--memory-budget',
+        dest='memory_budget', type=int, default=None,
+        help='Maximum memory (in MB) for the unet activations when testing (tiled testing)'
+    )
+    parser.add_argument(
+        '--sparse-labels',
+        action='store_true', dest='sparse_labels', default=False,
+        help='Use integer (uint8) label targets with a sparse categorical loss'
+    )
+    parser.add_argument(
+        '--dense-ensemble',
+        action='store_true', dest='dense_ensemble', default=False,
+        help='Test the ensemble densely (the convolutions are shared by overlapping patches)'
+    )
+    parser.add_argument(
+        '--embedding-cache',
+        dest='embedding_cache', default=None,
+        help='Folder for the cached VGG features of the survival slices (in the user cache folder by default)'
+    )
+    parser.add_argument(
+        '--fold-workers',
+        dest='fold_workers', type=int, default=1,
+        help='Number of worker processes for the survival leave-one-out folds (each one gets a subset of the CPUs)'
+    )
+    parser.add_argument(
+        '--survival-fold',
+        dest='survival_fold', type=int, default=None,
+        help='Only train and test this fold of the survival leave-one-out (used by the fold workers)'
+    )
+    parser.add_argument(
+        '--profile',
+        dest='profile_name', default=None,
+        help='JSON file for the timing, throughput and memory report of each stage of the pipeline'
+    )
 
     networks = {
         'unet': get_brats_unet,
@@ -198,31 +291,42 @@ def parse_inputs():
     return options
 
 
-def get_patient_survival_features(path, p, p_features, test=False):
-    # Init
-    options = parse_inputs()
+def get_patient_volume_features(roi_name, brain_name):
+    roi = load_nii(roi_name).get_data()
+    brain = load_nii(brain_name).get_data()
+    brain_vol = float(np.count_nonzero(brain))
+    return map(lambda l: np.count_nonzero(roi == l) / brain_vol, [1, 2, 4])
+
+
+def get_patient_roi_box(roi_name, brain_name):
+    # The slices depend on the number of slices, so we only store the brain bounding box and the ROI center.
+    roi = load_nii(roi_name).get_data()
+    brain = load_nii(brain_name).get_data()
+    bounding_box_min = np.min(np.nonzero(brain), axis=1)
+    bounding_box_max = np.max(np.nonzero(brain), axis=1)
+    center_of_masses = np.mean(np.nonzero(roi), axis=1, dtype=np.int)
+    return bounding_box_min, bounding_box_max, center_of_masses
+
+
+def get_patient_survival_features(path, p, p_features, options, store, test=False):
     roi_sufix = '_seg.nii.gz' if not test else '.nii.gz'
-    roi = load_nii(os.path.join(path, p, p + roi_sufix)).get_data()
-    brain = load_nii(os.path.join(path, p, p + options['t1'])).get_data()
-    brain_vol = np.count_nonzero(brain)
-    vol_features = map(lambda l: np.count_nonzero(roi == l) / brain_vol, [1, 2, 4])
+    source_names = [os.path.join(path, p, p + roi_sufix), os.path.join(path, p, p + options['t1'])]
+    vol_features = store.get(('volumes', p, roi_sufix), source_names, get_patient_volume_features)
     age_features = [float(p_features['Age']) / 100]
     features = [age_features + vol_features]
 
     return features
 
 
-def get_patient_roi_slice(path, p):
-    options = parse_inputs()
+def get_patient_roi_slice(path, p, options, store):
     n_slices = options['n_slices']
 
     # roi_sufix = '_seg.nii.gz' if not test else '.nii.gz'
     roi_sufix = '.nii.gz'
-    roi = load_nii(os.path.join(path, p, p + roi_sufix)).get_data()
-    brain = load_nii(os.path.join(path, p, p + options['t1'])).get_data()
-    bounding_box_min = np.min(np.nonzero(brain), axis=1)
-    bounding_box_max = np.max(np.nonzero(brain), axis=1)
-    center_of_masses = np.mean(np.nonzero(roi), axis=1, dtype=np.int)
+    source_names = [os.path.join(path, p, p + roi_sufix), os.path.join(path, p, p + options['t1'])]
+    bounding_box_min, bounding_box_max, center_of_masses = store.get(
+        ('roi_box', p, roi_sufix), source_names, get_patient_roi_box
+    )
     slices = [[
         slice(bounding_box_min[0], bounding_box_max[0] + 1),
         slice(bounding_box_min[1], bounding_box_max[1] + 1),
@@ -239,6 +343,11 @@ def get_survival_data(options, recession=list(['GTR', 'STR', 'NA']), test=False)
     else:
         path = options['loo_dir']
 
+    # The features only depend on the images, so we keep them with the patients (or in the cache folder,
+    # if the dataset folder is read-only). Without any writable folder, they are only kept in memory.
+    store_path = get_writable_path([path, get_cache_path('features', get_dataset_name(path))])
+    store = FeatureStore(os.path.join(store_path, 'survival_features.pkl') if store_path is not None else None)
+
     with open(os.path.join(path, 'survival_data.csv')) as csvfile:
         csvreader = csv.reader(csvfile, delimiter=',')
         names = csvreader.next()
@@ -258,14 +367,16 @@ def get_survival_data(options, recession=list(['GTR', 'STR', 'NA']), test=False)
         features = list()
         slices = list()
         names = list()
+        # Only the patients with a folder in the catalog
+        patients = set(get_patient_catalog(path).get_patients())
         for k, v in survivaldict.items():
-            if v['ResectionStatus'] in recession:
+            if v['ResectionStatus'] in recession and k in patients:
                 flair_names += [os.path.join(path, k, k + options['flair'])]
                 t1_names += [os.path.join(path, k, k + options['t1'])]
                 t1ce_names += [os.path.join(path, k, k + options['t1ce'])]
                 t2_names += [os.path.join(path, k, k + options['t2'])]
-                features += get_patient_survival_features(path, k, v, test)
-                slices += get_patient_roi_slice(path, k)
+                features += get_patient_survival_features(path, k, v, options, store, test)
+                slices += get_patient_roi_slice(path, k, options, store)
                 if not test:
                     survival += [float(v['Survival'])]
                 else:
@@ -285,18 +396,18 @@ def get_survival_data(options, recession=list(['GTR', 'STR', 'NA']), test=False)
 
 
 def get_names(sufix, path):
-    options = parse_inputs()
     if path is None:
+        options = parse_inputs()
         path = options['train_dir'][0] if options['train_dir'] is not None else options['loo_dir']
 
-    directories = filter(os.path.isdir, [os.path.join(path, f) for f in os.listdir(path)])
-    patients = sorted(directories)
-
-    return map(lambda p: os.path.join(p, p.split('/')[-1] + sufix), patients)
+    # The patient folders come from the catalog (the folder is only listed again if it changed).
+    return get_patient_catalog(path).get_names(sufix)
 
 
 def get_names_from_path(path=None):
     options = parse_inputs()
+    if path is None:
+        path = options['train_dir'][0] if options['train_dir'] is not None else options['loo_dir']
     # Prepare the names
     flair_names = get_names(options['flair'], path) if options['use_flair'] else None
     t2_names = get_names(options['t2'], path) if options['use_t2'] else None
@@ -317,19 +428,20 @@ def check_dsc(gt_name, image, nlabels):
     return [dsc_seg(gt == l, image == l) for l in labels[1:]]
 
 
-def get_cnn_labels(centers, names, nlabels):
+def get_cnn_labels(centers, names, nlabels, sparse=False):
     y = get_labels(
         label_names=names,
         list_of_centers=centers,
         nlabels=nlabels,
-        verbose=True
+        verbose=True,
+        sparse=sparse
     )
     print('%s- Concatenating the labels (cnn)' % ' '.join([''] * 12))
     y = np.concatenate(y)
     return y
 
 
-def get_fcnn_labels(centers, names, nlabels, patch_size=None):
+def get_fcnn_labels(centers, names, nlabels, patch_size=None, sparse=False):
     if patch_size is None:
         patch_size = (parse_inputs()['patch_width'],) * 3
     y = get_patch_labels(
@@ -337,25 +449,77 @@ def get_fcnn_labels(centers, names, nlabels, patch_size=None):
         list_of_centers=centers,
         output_size=patch_size,
         nlabels=nlabels,
-        verbose=True
+        verbose=True,
+        sparse=sparse
     )
     print('%s- Concatenating the labels (fcnn)' % ' '.join([''] * 12))
     y = np.concatenate(y)
     return y
 
 
-def get_cluster_labels(centers, names, nlabels):
+def get_cluster_labels(centers, names, nlabels, sparse=False):
     options = parse_inputs()
     conv_blocks = options['conv_blocks_seg']
-    y_cnn = get_cnn_labels(centers, names, nlabels)
-    y_fcnn = get_fcnn_labels(centers, names, nlabels, (3, 3, 3))
-    y_unet = get_fcnn_labels(centers, names, nlabels, (conv_blocks * 2 + 3,) * 3)
+    y_cnn = get_cnn_labels(centers, names, nlabels, sparse=sparse)
+    y_fcnn = get_fcnn_labels(centers, names, nlabels, (3, 3, 3), sparse=sparse)
+    y_unet = get_fcnn_labels(centers, names, nlabels, (conv_blocks * 2 + 3,) * 3, sparse=sparse)
 
     y = [y_unet, y_cnn, y_fcnn, y_cnn]
 
     return y
 
 
+# Version of the preprocessing of the survival slices (resizing, PCA and VGG input) for the cached embeddings.
+embedding_version = 'vgg16-224x224-pca3-float32-v2'
+
+
+def get_survival_embeddings(image_names, slices, n_slices, cache_path=None, verbose=False):
+    """
+    Function to get the VGG features of the survival slices for each patient. The VGG model is
+    frozen, so the features are computed once and cached on disk (one (n_slices, 7, 7, 512) array per
+    patient). They are computed again if the images are newer than the cached array. The key of each
+    array also includes the version of the slice preprocessing (embedding_version), so changing it
+    (for instance, the reshaping of get_reshaped_data) invalidates the cached arrays.
+    :param image_names: Image names for each patient.
+    :param slices: Slices of the ROI for each patient.
+    :param n_slices: Number of slices.
+    :param cache_path: Folder for the cached features (the embeddings folder of the user cache by default).
+    :param verbose: Whether to print the number of patients that need to be computed.
+    :return: Array of features (N, n_slices, 7, 7, 512).
+    """
+    cache_path = get_cache_path('embeddings') if cache_path is None else cache_path
+
+    def get_cache_name(names, p_slices):
+        patient_path = os.path.dirname(os.path.abspath(names[0]))
+        key = ';'.join(map(os.path.abspath, names) + map(lambda s: '%s:%s' % (s.start, s.stop), p_slices))
+        key_hash = hashlib.md5('%s;%d;%s' % (key, n_slices, embedding_version)).hexdigest()[:8]
+        return os.path.join(cache_path, '%s-vgg16-%s.npy' % (os.path.basename(patient_path), key_hash))
+
+    patients = zip(image_names, slices, map(get_cache_name, image_names, slices))
+    missing = filter(
+        lambda (names, p_slices, cache_name): not os.path.isfile(cache_name) or any(
+            map(lambda name: os.path.getmtime(name) > os.path.getmtime(cache_name), names)
+        ),
+        patients
+    )
+
+    if missing:
+        if verbose:
+            print('%s- Computing the VGG features for %d patients' % (' '.join([''] * 12), len(missing)))
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        base_model = get_brats_survival_base()
+        for names, p_slices, cache_name in missing:
+            x_vol = get_reshaped_data([names], [p_slices], (224, 224), n_slices=n_slices)[0]
+            x_vol = preprocess_input(np.moveaxis(x_vol, 2, 0).astype(np.float32))
+            # Same as with the volume store, we write to a temporary file and rename it.
+            tmp_name = '%s.%d.tmp.npy' % (cache_name[:-4], os.getpid())
+            np.save(tmp_name, base_model.predict(x_vol, batch_size=n_slices).astype(np.float32))
+            os.rename(tmp_name, cache_name)
+
+    return np.stack(map(lambda (names, p_slices, cache_name): np.load(cache_name), patients), axis=0)
+
+
 def train_survival_function(image_names, survival, features, slices, save_path, thresholds, sufix=''):
     # Init
     options = parse_inputs()
@@ -365,7 +529,12 @@ def train_survival_function(image_names, survival, features, slices, save_path,
     n_slices = options['n_slices']
 
     ''' Net preparation '''
-    net = get_brats_survival(thresholds=thresholds, n_slices=n_slices, n_features=features.shape[-1])
+    net = get_brats_survival(
+        thresholds=thresholds,
+        n_slices=n_slices,
+        n_features=features.shape[-1],
+        cached_features=True
+    )
     net_name = os.path.join(save_path, 'brats2018-survival%s.mdl' % sufix)
     net.save(net_name)
     # checkpoint = 'brats2018-survival%s.hdf5' % sufix
@@ -390,20 +559,21 @@ def train_survival_function(image_names, survival, features, slices, save_path,
             )
         )
 
-        # Data preparation
-        x_vol = get_reshaped_data(image_names, slices, (224, 224), n_slices=n_slices, verbose=True)
-        print('%s- Concatenating the data' % ' '.join([''] * 12))
-        x_vol = preprocess_input(np.stack(x_vol, axis=0))
+        # Data preparation (the features of the frozen VGG model are cached)
+        x_vol = get_survival_embeddings(image_names, slices, n_slices, options['embedding_cache'], verbose=True)
 
         print('%s-- X (volume) shape: (%s)' % (' '.join([''] * 12), ', '.join(map(str, x_vol.shape))))
         print('%s-- X (features) shape: (%s)' % (' '.join([''] * 12), ', '.join(map(str, features.shape))))
         print('%s-- Y shape: (%s)' % (' '.join([''] * 12), ', '.join(map(str, survival.shape))))
 
-        checkpoint = 'brats2018-survival%s-step.hdf5' % sufix
+        # The checkpoint is written during training, so only the final weights (renamed once the training
+        # is finished) mean that a previous run (or fold worker) already trained this network. Both names
+        # are different from the ones of the full VGG model (those weights do not fit this network).
+        checkpoint = 'brats2018-survival%s-features-step.hdf5' % sufix
+        final_name = os.path.join(save_path, 'brats2018-survival%s-features.hdf5' % sufix)
 
         try:
-            # net.load_weights(os.path.join(save_path, checkpoint))
-            net.load_weights(os.path.join(save_path, 'brats2018-survival%s-step%d.hdf5' % (sufix, train_steps - 1)))
+            net.load_weights(final_name)
             print(
                 '%s[%s] %sSurvival network weights %sloaded%s' % (
                     c['c'], strftime("%H:%M:%S"), c['g'],
@@ -458,6 +628,9 @@ def train_survival_function(image_names, survival, features, slices, save_path,
             # net.fit(x, y, batch_size=8, validation_split=options['sval_rate'], epochs=epochs, callbacks=callbacks)
             net.fit(x, [y, y_cat], batch_size=8, epochs=epochs, callbacks=callbacks)
             net.load_weights(os.path.join(save_path, checkpoint))
+            tmp_name = '%s.%d.tmp' % (final_name, os.getpid())
+            net.save_weights(tmp_name)
+            os.rename(tmp_name, final_name)
 
             ''' Curriculum learning version '''
             # sorted_idx = np.squeeze(np.argsort(survival, axis=0))
@@ -544,8 +717,8 @@ def train_survival_function(image_names, survival, features, slices, save_path,
 
 def test_survival(net, image_names, features, slices, n_slices):
     c = color_codes()
-    x_vol = get_reshaped_data(image_names, slices, (224, 224), n_slices=n_slices)
-    x_vol = np.stack(x_vol, axis=0)
+    options = parse_inputs()
+    x_vol = get_survival_embeddings(image_names, slices, n_slices, options['embedding_cache'])
 
     x = [x_vol.astype(np.float32), np.array(features, dtype=np.float32)]
     print(
@@ -590,7 +763,8 @@ def train_seg_function(image_names, label_names, brain_centers, save_path):
         input_shape=input_shape,
         filters_list=filters_list,
         kernel_size_list=kernel_size_list,
-        nlabels=options['nlabels']
+        nlabels=options['nlabels'],
+        sparse=options['sparse_labels']
     )
     train_seg(
         image_names=image_names,
@@ -610,7 +784,7 @@ def train_seg_function(image_names, label_names, brain_centers, save_path):
     print('%s%s<Creating the tumor masks for the training data>%s' % (
         ''.join([' '] * 14), c['g'], c['nc']
     ))
-    masks = map(lambda labels: load_nii(labels).get_data().astype(np.bool), label_names)
+    masks = map(lambda labels: load_volume(labels).astype(np.bool), label_names)
 
     # > Ensemble training
     #
@@ -619,10 +793,7 @@ def train_seg_function(image_names, label_names, brain_centers, save_path):
     print('%s- Extracting centers from the tumor ROI' % ' '.join([''] * 15))
     train_centers = get_mask_centers(masks)
     train_centers = map(
-        lambda centers: map(
-            tuple,
-            np.random.permutation(centers)[::options['down_sampling']].tolist()
-        ),
+        lambda centers: np.random.permutation(centers)[::options['down_sampling']],
         train_centers
     )
     print('%s- %d centers will be used' % (' '.join([''] * 15), sum(map(len, train_centers))))
@@ -634,7 +805,8 @@ def train_seg_function(image_names, label_names, brain_centers, save_path):
         filters_list=n_filters * conv_blocks_seg,
         kernel_size_list=[conv_width] * conv_blocks_seg,
         nlabels=options['nlabels'],
-        dense_size=dense_size
+        dense_size=dense_size,
+        sparse=options['sparse_labels']
     )
 
     # First we train the nets inside the cluster net (I don't know what other name I could
@@ -659,7 +831,8 @@ def train_seg_function(image_names, label_names, brain_centers, save_path):
         cnn=cnn,
         fcnn=fcnn,
         ucnn=ucnn,
-        nlabels=options['nlabels']
+        nlabels=options['nlabels'],
+        sparse=options['sparse_labels']
     )
     train_seg(
         image_names=image_names,
@@ -713,6 +886,63 @@ def train_seg(net, image_names, label_names, train_centers, save_path, sufix, nl
         )
 
         # net.summary()
+        if options['streaming']:
+            label_sizes_dict = {
+                'unet': [patch_size],
+                'ensemble': [None],
+                'nets': [(conv_blocks * 2 + 3,) * 3, None, (3, 3, 3), None],
+            }
+            n_samples = sum(map(len, train_centers))
+            n_val = int(n_samples * options['val_rate'])
+            idx = np.random.permutation(n_samples)
+            print('%s-- Streaming %d training and %d validation samples' % (
+                ' '.join([''] * 12),
+                n_samples - n_val, n_val
+            ))
+            train_data = PatchSequence(
+                image_names=image_names,
+                label_names=label_names,
+                list_of_centers=train_centers,
+                patch_size=patch_size,
+                label_sizes=label_sizes_dict[net_type],
+                nlabels=nlabels,
+                batch_size=batch_size,
+                indices=idx[n_val:],
+                sparse=options['sparse_labels']
+            )
+            # Sorting the validation samples keeps the patients together in each batch.
+            val_data = PatchSequence(
+                image_names=image_names,
+                label_names=label_names,
+                list_of_centers=train_centers,
+                patch_size=patch_size,
+                label_sizes=label_sizes_dict[net_type],
+                nlabels=nlabels,
+                batch_size=batch_size,
+                indices=np.sort(idx[:n_val]),
+                shuffle=False,
+                sparse=options['sparse_labels']
+            )
+
+            print('%s%sStarting the training process (%s%s%s%s) %s' % (
+                ' '.join([''] * 12),
+                c['g'],
+                c['b'], net_type, c['nc'],
+                c['g'], c['nc'])
+                  )
+            with profile_stage('fit') as stage:
+                history = net.fit_generator(
+                    train_data,
+                    validation_data=val_data,
+                    epochs=epochs,
+                    callbacks=callbacks,
+                    max_queue_size=options['queue_size'],
+                    workers=options['loader_workers']
+                )
+                stage['patches'] = (n_samples - n_val) * len(history.epoch)
+            net.load_weights(os.path.join(save_path, checkpoint))
+            return
+
         x = get_data(
             image_names=image_names,
             list_of_centers=train_centers,
@@ -720,11 +950,15 @@ def train_seg(net, image_names, label_names, train_centers, save_path, sufix, nl
             verbose=True,
         )
         print('%s- Concatenating the data' % ' '.join([''] * 12))
-        x = np.concatenate(x)
+        with profile_stage('concatenate') as stage:
+            x = np.concatenate(x)
+            stage['patches'] = len(x)
+            stage['bytes'] = x.nbytes
+        sparse = options['sparse_labels']
         get_labels_dict = {
-            'unet': lambda: get_fcnn_labels(train_centers, label_names, nlabels),
-            'ensemble': lambda: get_cnn_labels(train_centers, label_names, nlabels),
-            'nets': lambda: get_cluster_labels(train_centers, label_names, nlabels),
+            'unet': lambda: get_fcnn_labels(train_centers, label_names, nlabels, sparse=sparse),
+            'ensemble': lambda: get_cnn_labels(train_centers, label_names, nlabels, sparse=sparse),
+            'nets': lambda: get_cluster_labels(train_centers, label_names, nlabels, sparse=sparse),
         }
         y = get_labels_dict[net_type]()
         print('%s-- Using %d blocks of data' % (
@@ -740,10 +974,13 @@ def train_seg(net, image_names, label_names, train_centers, save_path, sufix, nl
                 print(y_message % (' '.join([''] * 12), ', '.join(map(str, yi.shape))))
 
         print('%s- Randomising the training data' % ' '.join([''] * 12))
-        idx = np.random.permutation(range(len(x)))
+        with profile_stage('shuffle') as stage:
+            idx = np.random.permutation(range(len(x)))
 
-        x = x[idx]
-        y = y[idx] if type(y) is not list else map(lambda yi: yi[idx], y)
+            x = x[idx]
+            y = y[idx] if type(y) is not list else map(lambda yi: yi[idx], y)
+            stage['patches'] = len(x)
+            stage['bytes'] = x.nbytes
 
         print('%s%sStarting the training process (%s%s%s%s) %s' % (
             ' '.join([''] * 12),
@@ -751,10 +988,37 @@ def train_seg(net, image_names, label_names, train_centers, save_path, sufix, nl
             c['b'], net_type, c['nc'],
             c['g'], c['nc'])
               )
-        net.fit(x, y, batch_size=batch_size, validation_split=options['val_rate'], epochs=epochs, callbacks=callbacks)
+        with profile_stage('fit') as stage:
+            history = net.fit(
+                x, y, batch_size=batch_size, validation_split=options['val_rate'], epochs=epochs, callbacks=callbacks
+            )
+            n_train = int(len(x) * (1. - options['val_rate']))
+            stage['patches'] = n_train * len(history.epoch)
         net.load_weights(os.path.join(save_path, checkpoint))
 
 
+image_nets = {'net': None, 'models': dict()}
+
+
+def get_image_net(net, input_shape, filters_list, kernel_size_list, nlabels):
+    # Building the image network and copying the weights takes a while (and the graphs pile up in memory),
+    # so we keep one network per input shape for the current trained network.
+    options = parse_inputs()
+    if image_nets['net'] is not net:
+        image_nets['net'] = net
+        image_nets['models'] = dict()
+    input_shape = tuple(input_shape)
+    try:
+        image_net = image_nets['models'][input_shape]
+    except KeyError:
+        image_net = options['net'](input_shape, filters_list, kernel_size_list, nlabels)
+        # We should copy the weights here (if not using roinet)
+        for l_new, l_orig in zip(image_net.layers[1:], net.layers[1:]):
+            l_new.set_weights(l_orig.get_weights())
+        image_nets['models'][input_shape] = image_net
+    return image_net
+
+
 def test_seg(net, p, outputname, nlabels, mask=None, verbose=True):
 
     c = color_codes()
@@ -773,20 +1037,6 @@ def test_seg(net, p, outputname, nlabels, mask=None, verbose=True):
         # Image loading
         if mask is None:
             # This is the unet path
-            x = np.expand_dims(np.stack(load_images(p), axis=0), axis=0)
-            # Network parameters
-            conv_blocks = options['conv_blocks']
-            n_filters = options['n_filters']
-            filters_list = n_filters if len(n_filters) > 1 else n_filters * conv_blocks
-            conv_width = options['conv_width']
-            kernel_size_list = conv_width if isinstance(conv_width, list) else [conv_width] * conv_blocks
-
-            image_net = options['net'](x.shape[1:], filters_list, kernel_size_list, nlabels)
-            # We should copy the weights here (if not using roinet)
-            for l_new, l_orig in zip(image_net.layers[1:], net.layers[1:]):
-                l_new.set_weights(l_orig.get_weights())
-
-            # Now we can test
             if verbose:
                 print('%s[%s] %sTesting the network%s' % (c['c'], strftime("%H:%M:%S"), c['g'], c['nc']))
             # Load only the patient images
@@ -798,8 +1048,48 @@ def test_seg(net, p, outputname, nlabels, mask=None, verbose=True):
                     c['b'], outputname_path, c['nc'],
                     c['g'], c['nc']
                 ))
-            pr_maps = image_net.predict(x, batch_size=options['test_size'])
-            image = np.argmax(pr_maps, axis=-1).reshape(x.shape[2:])
+            # Network parameters
+            conv_blocks = options['conv_blocks']
+            n_filters = options['n_filters']
+            filters_list = n_filters if len(n_filters) > 1 else n_filters * conv_blocks
+            conv_width = options['conv_width']
+            kernel_size_list = conv_width if isinstance(conv_width, list) else [conv_width] * conv_blocks
+
+            def image_net_builder(input_shape):
+                return get_image_net(net, input_shape, filters_list, kernel_size_list, nlabels)
+
+            if options['sliding_stride'] is not None:
+                # Tiled version (the patch network is used directly, so the memory is bounded by the batch).
+                patch_width = options['patch_width']
+                pr_maps = sliding_window_predict(
+                    net,
+                    load_images(p),
+                    (patch_width,) * 3,
+                    stride=(options['sliding_stride'],) * 3,
+                    batch_size=options['batch_size'],
+                    weighting=options['blending'],
+                    datatype=np.float16 if options['float16_accumulator'] else np.float32
+                )
+                image = np.argmax(pr_maps, axis=-1)
+            elif options['memory_budget'] is not None:
+                # Exact tiled version of the whole volume prediction (the tiles overlap by the receptive field).
+                x = load_images(p)
+                tile_width = get_unet_tile_width(
+                    options['memory_budget'] * 1024 ** 2,
+                    len(x),
+                    filters_list,
+                    kernel_size_list,
+                    nlabels
+                )
+                pr_maps = tiled_predict(image_net_builder, x, (tile_width,) * 3, get_unet_halo(kernel_size_list))
+                image = np.argmax(pr_maps, axis=-1)
+            else:
+                x = np.expand_dims(np.stack(load_images(p), axis=0), axis=0)
+                image_net = image_net_builder(x.shape[1:])
+
+                # Now we can test
+                pr_maps = image_net.predict(x, batch_size=options['test_size'])
+                image = np.argmax(pr_maps, axis=-1).reshape(x.shape[2:])
             image = get_biggest_region(image)
         else:
             # This is the ensemble path
@@ -807,16 +1097,28 @@ def test_seg(net, p, outputname, nlabels, mask=None, verbose=True):
             options = parse_inputs()
             conv_blocks = options['conv_blocks_seg']
             test_centers = get_mask_blocks(mask)
-            x = get_data(
-                image_names=[p],
-                list_of_centers=[test_centers],
-                patch_size=(conv_blocks * 2 + 3,) * 3,
-                verbose=verbose,
-            )
-            if verbose:
-                print('%s- Concatenating the data x' % ' '.join([''] * 12))
-            x = np.concatenate(x)
-            pr_maps = net.predict(x, batch_size=options['test_size'])
+            if options['dense_ensemble']:
+                # The net is the pair of networks from get_brats_dense_ensemble.
+                conv_net, deconv_net = net
+                pr_maps = dense_ensemble_predict(
+                    conv_net,
+                    deconv_net,
+                    load_images(p),
+                    test_centers,
+                    (conv_blocks * 2 + 3,) * 3,
+                    batch_size=options['test_size']
+                )
+            else:
+                x = get_data(
+                    image_names=[p],
+                    list_of_centers=[test_centers],
+                    patch_size=(conv_blocks * 2 + 3,) * 3,
+                    verbose=verbose,
+                )
+                if verbose:
+                    print('%s- Concatenating the data x' % ' '.join([''] * 12))
+                x = np.concatenate(x)
+                pr_maps = net.predict(x, batch_size=options['test_size'])
             [x, y, z] = np.stack(test_centers, axis=1)
             image[x, y, z] = np.argmax(pr_maps, axis=1).astype(dtype=np.int8)
 
@@ -825,9 +1127,207 @@ def test_seg(net, p, outputname, nlabels, mask=None, verbose=True):
     return roi_nii
 
 
+def get_survival_fold_name(path, fold):
+    return os.path.join(path, 'survival_results-fold%d.csv' % fold)
+
+
+def survival_fold(options, fold):
+    """
+    Function to train and test one fold of the survival leave-one-out. The results are written to
+    their own csv file (see get_survival_fold_name) that is merged by run_survival_folds.
+    :param options: Command line options.
+    :param fold: Index of the fold.
+    :return: None.
+    """
+    c = color_codes()
+    tst_simage_names, tst_survival, tst_features, tst_slices = get_survival_data(options, recession=['GTR'])
+    max_survival = np.max(tst_survival)
+    n_folds = len(tst_simage_names)
+
+    ''' Training '''
+    ini_p = len(tst_simage_names) * fold / n_folds
+    end_p = len(tst_simage_names) * (fold + 1) / n_folds
+    # Validation data
+    p = tst_simage_names[ini_p:end_p]
+    p_features = tst_features[ini_p:end_p]
+    p_slices = tst_slices[ini_p:end_p]
+    p_survival = tst_survival[ini_p:end_p]
+    # Training data
+    train_images = np.concatenate([
+        tst_simage_names[:ini_p, :],
+        tst_simage_names[end_p:, :],
+        # simage_names
+    ], axis=0)
+    train_survival = np.asarray(
+        tst_survival.tolist()[:ini_p] + tst_survival.tolist()[end_p:]  # + survival.tolist()
+    )
+    train_features = np.asarray(
+        tst_features.tolist()[:ini_p] + tst_features.tolist()[end_p:]  # + features.tolist()
+    )
+    train_slices = tst_slices[:ini_p] + tst_slices[end_p:]  # + slices
+
+    # Patient info
+    p_name = map(lambda pi: pi[0].rsplit('/')[-2], p)
+
+    # Data stuff
+    print('%s[%s] %sFold %s(%s%d%s%s/%d)%s' % (
+        c['c'], strftime("%H:%M:%S"),
+        c['g'], c['c'], c['b'], fold + 1, c['nc'], c['c'], n_folds, c['nc']
+    ))
+
+    print(
+        '%s[%s] %sStarting training (%ssurvival%s)%s' % (
+            c['c'], strftime("%H:%M:%S"),
+            c['g'], c['b'], c['nc'] + c['g'], c['nc']
+        )
+    )
+
+    snet = train_survival_function(
+        train_images,
+        train_survival / max_survival,
+        train_features,
+        train_slices,
+        thresholds=[300 / max_survival, 450 / max_survival],
+        save_path=options['loo_dir'],
+        sufix='-fold%d' % fold
+    )
+
+    ''' Testing '''
+    survival_out = test_survival(
+        snet,
+        p,
+        p_features,
+        p_slices,
+        options['n_slices']
+    ) * max_survival
+    print(
+        '%s[%s] %sPatient %s%s%s predicted survival = %s%f (%f)%s' % (
+            c['c'], strftime("%H:%M:%S"),
+            c['g'], c['b'], p_name[0], c['nc'],
+            c['g'], survival_out, p_survival, c['nc']
+        )
+    )
+
+    # The file is renamed at the end, so an unfinished fold never looks finished.
+    fold_name = get_survival_fold_name(options['loo_dir'], fold)
+    tmp_name = '%s.%d.tmp' % (fold_name, os.getpid())
+    with open(tmp_name, 'w') as csvfile:
+        csvwriter = csv.writer(csvfile, delimiter=',')
+        csvwriter.writerow([p_name[0], '%f' % float(survival_out)])
+    os.rename(tmp_name, fold_name)
+
+
+def run_survival_folds(options):
+    """
+    Function to run the survival leave-one-out. Folds that already have results are skipped. With more
+    than one fold worker, each fold runs in its own process (the same script with --survival-fold) pinned
+    to a subset of the CPUs, with its thread counts limited to that subset. Once all the folds are
+    finished, their results are merged (in fold order) into survival_results.csv. If any fold has no
+    results (a worker failed), nothing is merged and the script exits with an error (running it again
+    only runs the missing folds).
+    :param options: Command line options.
+    :return: None.
+    """
+    c = color_codes()
+    path = options['loo_dir']
+    tst_simage_names, _, _, tst_slices = get_survival_data(options, recession=['GTR'])
+    n_folds = len(tst_simage_names)
+    folds = filter(lambda fold: not os.path.isfile(get_survival_fold_name(path, fold)), range(n_folds))
+    n_workers = min(options['fold_workers'], len(folds))
+    print('%s[%s] %sStarting leave-one-out (survival)%s' % (c['c'], strftime("%H:%M:%S"), c['g'], c['nc']))
+    print('%s- %d/%d folds left' % (' '.join([''] * 12), len(folds), n_folds))
+    failed = list()
+
+    if n_workers > 1:
+        # The VGG features are shared by all the folds, so we compute them once before starting the workers.
+        get_survival_embeddings(
+            tst_simage_names, tst_slices, options['n_slices'], options['embedding_cache'], verbose=True
+        )
+        worker_cpus = np.array_split(range(cpu_count()), n_workers)
+        taskset = find_executable('taskset')
+        workers = dict()
+        while folds or workers:
+            for worker in filter(lambda w: w not in workers, range(n_workers)):
+                if folds:
+                    fold = folds.pop(0)
+                    cpus = worker_cpus[worker]
+                    env = dict(os.environ)
+                    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+                        env[var] = str(len(cpus))
+                    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+                    command += ['--survival-fold', str(fold)]
+                    if taskset is not None:
+                        command = [taskset, '-c', ','.join(map(str, cpus))] + command
+                    workers[worker] = (fold, subprocess.Popen(command, env=env))
+            for worker, (fold, process) in workers.items():
+                if process.poll() is not None:
+                    del workers[worker]
+                    if process.returncode != 0:
+                        failed.append(fold)
+                        print('%s[%s] %sFold %d failed (exit code %d)%s' % (
+                            c['c'], strftime("%H:%M:%S"), c['r'], fold, process.returncode, c['nc']
+                        ))
+            sleep(1)
+    else:
+        for fold in folds:
+            survival_fold(options, fold)
+
+    missing = filter(lambda fold: not os.path.isfile(get_survival_fold_name(path, fold)), range(n_folds))
+    if missing:
+        print('%s[%s] %sNo results for folds %s (failed workers: %s), run it again to finish them%s' % (
+            c['c'], strftime("%H:%M:%S"), c['r'],
+            ', '.join(map(str, missing)), ', '.join(map(str, sorted(failed))) if failed else 'none',
+            c['nc']
+        ))
+        sys.exit(1)
+
+    with open(os.path.join(path, 'survival_results.csv'), 'w') as csvfile:
+        csvwriter = csv.writer(csvfile, delimiter=',')
+        for fold in range(n_folds):
+            with open(get_survival_fold_name(path, fold)) as fold_file:
+                for row in csv.reader(fold_file, delimiter=','):
+                    csvwriter.writerow(row)
+
+
+def set_worker_threads(threads):
+    # The thread pools of tensorflow are not limited by the OpenMP variables.
+    K.set_session(tf.Session(config=tf.ConfigProto(
+        intra_op_parallelism_threads=threads,
+        inter_op_parallelism_threads=threads
+    )))
+
+
 def main():
     options = parse_inputs()
     c = color_codes()
+    set_volume_cache_size(options['volume_cache'] * 1024 ** 2)
+    set_loader_workers(options['loader_workers'])
+    set_catalog_store(options['catalog_store'])
+    if (options['streaming'] or options['loader_workers'] > 1) and options['volume_store'] is None:
+        # Each streamed batch reads patches from many patients and each loader worker has its own
+        # volume cache, so the volumes have to be memory-mapped.
+        options['volume_store'] = get_cache_path('volumes')
+        print('%s[%s] %sUsing the volume store %s%s%s' % (
+            c['c'], strftime("%H:%M:%S"), c['g'], c['b'], options['volume_store'], c['nc']
+        ))
+    if options['volume_store'] is not None:
+        set_volume_store(options['volume_store'])
+    if options['profile_name'] is not None:
+        # The report is also written if the run stops halfway. The survival fold workers
+        # (see run_survival_folds) get the same arguments, so each one writes its own report.
+        profile_name = options['profile_name']
+        if options['survival_fold'] is not None:
+            profile_root, profile_ext = os.path.splitext(profile_name)
+            profile_name = '%s.fold%d%s' % (profile_root, options['survival_fold'], profile_ext)
+        set_profiling(True)
+        atexit.register(save_profile, profile_name)
+
+    if options['survival_fold'] is not None:
+        # Fold worker (see run_survival_folds)
+        if 'OMP_NUM_THREADS' in os.environ:
+            set_worker_threads(int(os.environ['OMP_NUM_THREADS']))
+        survival_fold(options, options['survival_fold'])
+        return
 
     # Prepare the net hyperparameters
     epochs = options['epochs']
@@ -857,6 +1357,9 @@ def main():
     ensemble_roi_results = list()
     image_names, label_names = get_names_from_path()
     print('%s[%s] %s<BRATS 2018 pipeline testing>%s' % (c['c'], strftime("%H:%M:%S"), c['y'], c['nc']))
+    if options['volume_store'] is not None:
+        print('%s[%s] %sPreprocessing the volumes%s' % (c['c'], strftime("%H:%M:%S"), c['g'], c['nc']))
+        preprocess_patients(image_names, options['volume_store'], label_names=label_names, verbose=True)
     print('%s[%s] %sCenter computation%s' % (c['c'], strftime("%H:%M:%S"), c['g'], c['nc']))
     # Block center computation
     overlap = 0 if options['netname'] != 'roinet' else patch_width / 4
@@ -950,77 +1453,7 @@ def main():
         # print('Final CNN results DSC: (%f/%f/%f)' % cnn_f_dsc)
 
         ''' <Survival task> '''
-        tst_simage_names, tst_survival, tst_features, tst_slices = get_survival_data(options, recession=['GTR'])
-        max_survival = np.max(tst_survival)
-        n_folds = len(tst_simage_names)
-        print('%s[%s] %sStarting leave-one-out (survival)%s' % (c['c'], strftime("%H:%M:%S"), c['g'], c['nc']))
-        with open(os.path.join(options['loo_dir'], 'survival_results.csv'), 'w') as csvfile:
-            csvwriter = csv.writer(csvfile, delimiter=',')
-            for i in range(n_folds):
-                ''' Training '''
-                ini_p = len(tst_simage_names) * i / n_folds
-                end_p = len(tst_simage_names) * (i + 1) / n_folds
-                # Validation data
-                p = tst_simage_names[ini_p:end_p]
-                p_features = tst_features[ini_p:end_p]
-                p_slices = tst_slices[ini_p:end_p]
-                p_survival = tst_survival[ini_p:end_p]
-                # Training data
-                train_images = np.concatenate([
-                    tst_simage_names[:ini_p, :],
-                    tst_simage_names[end_p:, :],
-                    # simage_names
-                ], axis=0)
-                train_survival = np.asarray(
-                    tst_survival.tolist()[:ini_p] + tst_survival.tolist()[end_p:] # + survival.tolist()
-                )
-                train_features = np.asarray(
-                    tst_features.tolist()[:ini_p] + tst_features.tolist()[end_p:] # + features.tolist()
-                )
-                train_slices = tst_slices[:ini_p] + tst_slices[end_p:] # + slices
-
-                # Patient info
-                p_name = map(lambda pi: pi[0].rsplit('/')[-2], p)
-
-                # Data stuff
-                print('%s[%s] %sFold %s(%s%d%s%s/%d)%s' % (
-                    c['c'], strftime("%H:%M:%S"),
-                    c['g'], c['c'], c['b'], i + 1, c['nc'], c['c'], n_folds, c['nc']
-                ))
-
-                print(
-                    '%s[%s] %sStarting training (%ssurvival%s)%s' % (
-                        c['c'], strftime("%H:%M:%S"),
-                        c['g'], c['b'], c['nc'] + c['g'], c['nc']
-                    )
-                )
-
-                snet = train_survival_function(
-                    train_images,
-                    train_survival / max_survival,
-                    train_features,
-                    train_slices,
-                    thresholds=[300 / max_survival, 450 / max_survival],
-                    save_path=options['loo_dir'],
-                    sufix='-fold%d' % i
-                )
-
-                ''' Testing '''
-                survival_out = test_survival(
-                    snet,
-                    p,
-                    p_features,
-                    p_slices,
-                    options['n_slices']
-                ) * max_survival
-                print(
-                    '%s[%s] %sPatient %s%s%s predicted survival = %s%f (%f)%s' % (
-                        c['c'], strftime("%H:%M:%S"),
-                        c['g'], c['b'], p_name[0], c['nc'],
-                        c['g'], survival_out, p_survival, c['nc']
-                    )
-                )
-                csvwriter.writerow([p_name[0], '%f' % float(survival_out)])
+        run_survival_folds(options)
 
     else:
 
@@ -1037,6 +1470,11 @@ def main():
 
         # net, ensemble = train_seg_function(image_names, label_names, brain_centers, save_path=test_dir)
         net, ensemble = train_seg_function(image_names, label_names, brain_centers, save_path=train_dir)
+        # The ensemble is only used for testing from now on.
+        if options['dense_ensemble']:
+            ensemble = get_brats_dense_ensemble(ensemble)
+        else:
+            ensemble = get_brats_fused_ensemble(ensemble)
 
         ''' Testing '''
         print('%s[%s] %sStarting testing (segmentation)%s' % (c['c'], strftime("%H:%M:%S"), c['g'], c['nc']))
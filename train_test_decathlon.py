@@ -37,14 +37,38 @@ import pdb
 import time
 import os
 import platform
+import queue
+import threading
 
 # Loading the image data. This requires downloading the CIFAR 10 dataset (Python version) - https://www.cs.toronto.edu/~kriz/cifar.html
-imagedata = np.zeros((0, 1024 * 3))
-for numfile in range(4):
-    with open('./data_batch_' + str(numfile + 1), 'rb') as fo:
-        # imagedict = pickle.load(fo)  # Python 2
-        imagedict = pickle.load(fo, encoding='bytes')  # Python 3
-    imagedata = np.concatenate((imagedata, imagedict[b'data']), axis=0)
+# The batches are converted once to grayscale (mean of the RGB channels) and cached as a uint8 (N, 1024)
+# array that is memory-mapped afterwards. Nothing is loaded until the first episode is needed.
+imagedata = None
+
+
+def loadImageData(datapath='.', cachename='cifar_gray.npy'):
+    cachefile = os.path.join(datapath, cachename)
+    if not os.path.isfile(cachefile):
+        batches = []
+        for numfile in range(4):
+            with open(os.path.join(datapath, 'data_batch_' + str(numfile + 1)), 'rb') as fo:
+                # imagedict = pickle.load(fo)  # Python 2
+                imagedict = pickle.load(fo, encoding='bytes')  # Python 3
+            rgb = imagedict[b'data'].reshape((-1, 3, 1024))
+            batches.append(np.round(rgb.sum(1, dtype=np.uint16) / 3.).astype(np.uint8))
+        # Written to a temporary file and renamed (several runs might share the same folder)
+        tmpfile = cachefile + '.' + str(os.getpid()) + '.tmp.npy'
+        np.save(tmpfile, np.concatenate(batches, axis=0))
+        os.replace(tmpfile, cachefile)
+    return np.load(cachefile, mmap_mode='r')
+
+
+def getImageData():
+    global imagedata
+    if imagedata is None:
+        imagedata = loadImageData()
+    return imagedata
+
 
 np.set_printoptions(precision=4)
 
@@ -62,68 +86,104 @@ defaultParams = {
     'lr': 1e-4,  # Adam learning rate
     'print_every': 10,  # how often to print statistics and save files
     'homogenous': 0,  # whether alpha should be shared across connections
+    'batchsize': 1,  # number of episodes per iteration (the loss is averaged over them)
     'rngseed': 0  # random seed
 }
 
-# ttype = torch.FloatTensor;         # For CPU
-ttype = torch.cuda.FloatTensor;  # For GPU
+# The tensor type (CPU or GPU) is selected at runtime (see setDevice). By default, the GPU is used if available.
+ttype = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
+
 
+def setDevice(device='auto'):
+    # device can be 'cpu', 'gpu' or 'auto' (GPU if available)
+    global ttype
+    if device == 'auto':
+        device = 'gpu' if torch.cuda.is_available() else 'cpu'
+    ttype = torch.cuda.FloatTensor if device == 'gpu' else torch.FloatTensor
 
-# Generate the full list of inputs for an episode
-def generateInputsAndTarget(params, contiguousperturbation=True):
-    # print(("Input Boost:", params['inputboost']))
-    inputT = np.zeros((params['nbsteps'], 1, params['nbneur']))  # inputTensor, initially in numpy format...
+
+# Generate the full list of inputs for an episode (numpy arrays)
+def generateEpisode(params, contiguousperturbation=True, rng=np.random):
     # Create the random patterns to be memorized in an episode
     # Floating-point, graded patterns, zero-mean
-    patterns = []
-    for nump in range(params['nbpatterns']):
-        numpic = np.random.randint(imagedata.shape[0])
-        p = imagedata[numpic].reshape((3, 1024)).sum(0).astype(float)
-        p = p[:params['patternsize']]
-        p = p - np.mean(p)
-        p = p / (1e-8 + np.max(np.abs(p)))
-        # p = (np.random.randint(2, size=params['patternsize']) - .5) *2   # Binary patterns
-        patterns.append(p)
-    # print "patterns generated!"
-    # Now 'patterns' contains the NBPATTERNS patterns to be memorized in this episode - in numpy format
+    images = getImageData()
+    numpics = rng.randint(images.shape[0], size=params['nbpatterns'])
+    # The images are already grayscale (the normalisation below does not depend on the scale)
+    patterns = images[numpics, :params['patternsize']].astype(np.float32)
+    patterns -= patterns.mean(axis=1, keepdims=True)
+    patterns /= 1e-8 + np.abs(patterns).max(axis=1, keepdims=True)
+    # Now 'patterns' contains the NBPATTERNS patterns to be memorized in this episode
     # Creating the test pattern, partially zero'ed out, that the network will have to complete
-    testpattern = random.choice(patterns).copy()
-    preservedbits = np.ones(params['patternsize'])
+    testpattern = patterns[rng.randint(params['nbpatterns'])].copy()
+    preservedbits = np.ones(params['patternsize'], dtype=np.float32)
 
     if contiguousperturbation:
         # Contiguous perturbation = one contiguous half of the image is zeroed out. Default (see above).
         preservedbits[int(params['patternsize'] / 2):] = 0
-        if np.random.rand() < .5:
+        if rng.rand() < .5:
             preservedbits = 1 - preservedbits
     else:
         # Otherwise, randomly zero out individual pixels. Because natural images are highly autocorrelated,
         # a trivial approximate solution is to take the average of nearby pixels.
-        preservedbits[:int(params['probadegrade'] * params['patternsize'])] = 0;
-        np.random.shuffle(preservedbits)
+        preservedbits[:int(params['probadegrade'] * params['patternsize'])] = 0
+        rng.shuffle(preservedbits)
     degradedtestpattern = testpattern * preservedbits
 
-    # Inserting the inputs in the input tensor at the proper places
-    for nc in range(params['nbprescycles']):
-        np.random.shuffle(patterns)
-        for ii in range(params['nbpatterns']):
-            for nn in range(params['prestime']):
-                numi = nc * (params['nbpatterns'] * (params['prestime'] + params['interpresdelay'])) + \
-                       ii * (params['prestime'] + params['interpresdelay']) + nn
-                inputT[numi][0][:params['patternsize']] = patterns[ii][:]
-
-    for nn in range(params['prestimetest']):
-        inputT[-params['prestimetest'] + nn][0][:params['patternsize']] = degradedtestpattern[:]
+    # Inserting the inputs in the input tensor at the proper places. Each presentation cycle is a
+    # (nbpatterns, prestime + interpresdelay) block of steps with the patterns in a random order.
+    inputT = np.zeros((params['nbsteps'], 1, params['nbneur']), dtype=np.float32)
+    cyclesteps = params['nbprescycles'] * params['nbpatterns'] * (params['prestime'] + params['interpresdelay'])
+    cycles = inputT[:cyclesteps, 0].reshape(
+        (params['nbprescycles'], params['nbpatterns'], params['prestime'] + params['interpresdelay'], -1)
+    )
+    order = np.argsort(rng.rand(params['nbprescycles'], params['nbpatterns']), axis=1)
+    cycles[:, :, :params['prestime'], :params['patternsize']] = patterns[order][:, :, np.newaxis, :]
+    inputT[-params['prestimetest']:, 0, :params['patternsize']] = degradedtestpattern
+    inputT[:, 0, -1] = 1.0  # Bias neuron is forced to 1
+
+    return inputT, testpattern
+
+
+# Generate the inputs for a batch of independent episodes (numpy arrays)
+def generateBatch(params, contiguousperturbation=True, rng=np.random):
+    # inputs: (nbsteps, batchsize, nbneur), targets: (batchsize, patternsize)
+    episodes = [generateEpisode(params, contiguousperturbation, rng) for _ in range(params['batchsize'])]
+    inputT = np.concatenate([inputT for inputT, _ in episodes], axis=1)
+    target = np.stack([testpattern for _, testpattern in episodes], axis=0)
+    return inputT, target
 
-    for nn in range(params['nbsteps']):
-        inputT[nn][0][-1] = 1.0  # Bias neuron is forced to 1
-        # inputT[nn] *= params['inputboost']       # Strengthen inputs
 
+# Generate the full list of inputs for a batch of episodes (tensors)
+def generateInputsAndTarget(params, contiguousperturbation=True, rng=np.random):
+    inputT, target = generateBatch(params, contiguousperturbation, rng)
     inputT = torch.from_numpy(inputT).type(ttype)  # Convert from numpy to Tensor
-    target = torch.from_numpy(testpattern).type(ttype)
+    target = torch.from_numpy(target).type(ttype)
 
     return inputT, target
 
 
+class EpisodeBuffer(object):
+    # Ring buffer of episode batches (numpy arrays) pre-generated by background threads. Each thread has its
+    # own random state (seeded from rngseed), so the episodes are reproducible with only one thread.
+    def __init__(self, params, size=16, workers=1, contiguousperturbation=True):
+        self.params = params
+        self.contiguousperturbation = contiguousperturbation
+        self.episodes = queue.Queue(maxsize=size)
+        for numworker in range(workers):
+            rng = np.random.RandomState(params['rngseed'] + numworker + 1)
+            worker = threading.Thread(target=self.fill, args=(rng,))
+            worker.daemon = True
+            worker.start()
+
+    def fill(self, rng):
+        while True:
+            self.episodes.put(generateBatch(self.params, self.contiguousperturbation, rng))
+
+    def get(self):
+        inputT, target = self.episodes.get()
+        return torch.from_numpy(inputT).type(ttype), torch.from_numpy(target).type(ttype)
+
+
 class Network(nn.Module):
     def __init__(self, params):
         super(Network, self).__init__()
@@ -149,30 +209,94 @@ class Network(nn.Module):
         self.params = params
 
     def forward(self, input, yin, hebb):
+        # Batched version: input and yin are (B, N) and each episode has its own Hebbian trace (B, N, N).
         # Inputs are fed by clamping the output of cells that receive input at the input value,
-        # like in standard Hopfield networks
-        # clamps = torch.zeros(1, self.params['nbneur'])
-        clamps = np.zeros(self.params['nbneur'])
-        zz = torch.nonzero(input.data[0].cpu()).numpy().squeeze()
-        # print(zz, zz.shape)
-        clamps[zz] = 1
-        # print(clamps)
-        clamps = Variable(torch.from_numpy(clamps).type(ttype), requires_grad=False).float()
-        yout = F.tanh(yin.mm(self.w + torch.mul(self.alpha, hebb))) * (1 - clamps) + input * clamps
+        # like in standard Hopfield networks. The clamps are computed on the same device as the input
+        # (no transfers to the host at each step).
+        clamps = Variable((input.data != 0).type(ttype), requires_grad=False)
+        yout = F.tanh(torch.bmm(yin.unsqueeze(1), self.w + torch.mul(self.alpha, hebb)).squeeze(1))
+        yout = yout * (1 - clamps) + input * clamps
         # bmm used to implement outer product
-        hebb = (1 - self.eta) * hebb + self.eta * torch.bmm(yin.unsqueeze(2), yout.unsqueeze(1))[0]
+        hebb = (1 - self.eta) * hebb + self.eta * torch.bmm(yin.unsqueeze(2), yout.unsqueeze(1))
         return yout, hebb
 
     def initialZeroState(self):
-        return Variable(torch.zeros(1, self.params['nbneur']).type(ttype))
+        return Variable(torch.zeros(self.params['batchsize'], self.params['nbneur']).type(ttype))
 
     def initialZeroHebb(self):
-        return Variable(torch.zeros(self.params['nbneur'], self.params['nbneur']).type(ttype))
-
-
-def train(paramdict=None):
+        return Variable(
+            torch.zeros(self.params['batchsize'], self.params['nbneur'], self.params['nbneur']).type(ttype)
+        )
+
+
+class ResultsWriter(object):
+    # Results files written by a background thread (so training does not wait for the disk):
+    # - loss_<suffix>.txt: append-only log with one mean loss per line.
+    # - results_<suffix>.dat: checkpoint with w, alpha, eta, the number of losses and the params (the losses
+    #   are in the log, so the checkpoint does not grow with the iterations). It is written to a temporary
+    #   file and renamed, so it is never half-written.
+    def __init__(self, suffix):
+        self.lossfile = 'loss_' + suffix + '.txt'
+        self.resultsfile = 'results_' + suffix + '.dat'
+        # A new training run starts a new log.
+        open(self.lossfile, 'w').close()
+        self.jobs = queue.Queue()
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            job()
+
+    def log(self, loss):
+        self.jobs.put(lambda: self.appendLoss(loss))
+
+    def appendLoss(self, loss):
+        with open(self.lossfile, 'a') as thefile:
+            thefile.write("%s\n" % loss)
+
+    def checkpoint(self, net, all_losses, params):
+        # The weights are copied now (the training loop keeps updating them).
+        snapshot = [np.array(v.data.cpu().numpy(), copy=True) for v in [net.w, net.alpha, net.eta]]
+        snapshot += [len(all_losses), dict(params)]
+        self.jobs.put(lambda: self.saveResults(snapshot))
+
+    def saveResults(self, snapshot):
+        tmpfile = self.resultsfile + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpfile, 'wb') as fo:
+            for item in snapshot:
+                pickle.dump(item, fo)
+        os.replace(tmpfile, self.resultsfile)
+
+    def close(self):
+        # Wait for the pending writes
+        self.jobs.put(None)
+        self.worker.join()
+
+
+# Load the results of a training run. The weights and params come from the last checkpoint and the
+# losses from the log (it might have more entries than the checkpoint). Older checkpoints have the whole
+# list of losses instead of their number, so they are still used when there is no log.
+def loadResults(suffix):
+    with open('results_' + suffix + '.dat', 'rb') as fo:
+        w, alpha, eta, checkpointlosses, params = [pickle.load(fo) for _ in range(5)]
+    try:
+        with open('loss_' + suffix + '.txt') as thefile:
+            all_losses = [float(line) for line in thefile if line.strip()]
+    except IOError:
+        all_losses = checkpointlosses if isinstance(checkpointlosses, list) else []
+    return {'w': w, 'alpha': alpha, 'eta': eta, 'losses': all_losses, 'params': params}
+
+
+def train(paramdict=None, device='auto', bufferworkers=0, buffersize=16, saveevery=100):
     # params = dict(click.get_current_context().params)
     print("Starting training...")
+    setDevice(device)
+    print("Tensor type: ", ttype)
     params = {}
     params.update(defaultParams)
     if paramdict:
@@ -184,8 +308,10 @@ def train(paramdict=None):
                 (params['prestime'] + params['interpresdelay']) * params['nbpatterns']) + params[
                             'prestimetest']  # Total number of steps per episode
     params['nbneur'] = params['patternsize'] + 1
+    # The batch size only appears in the suffix when it's not 1 (so the names of the previous runs do not change).
     suffix = "images_" + "".join([str(x) + "_" if pair[0] is not 'nbneur' and pair[0] is not 'nbsteps' and pair[
-        0] is not 'print_every' and pair[0] is not 'rngseed' else '' for pair in zip(params.keys(), params.values()) for
+        0] is not 'print_every' and pair[0] is not 'rngseed' and (pair[0] != 'batchsize' or pair[1] != 1) else ''
+                                  for pair in zip(params.keys(), params.values()) for
                                   x in pair])[:-1] + '_rngseed_' + str(
         params['rngseed'])  # Turning the parameters into a nice suffix for filenames; rngseed always appears last
 
@@ -196,6 +322,10 @@ def train(paramdict=None):
     torch.manual_seed(params['rngseed'])
     # print(click.get_current_context().params)
 
+    # The image data is loaded before the episode threads start
+    print("Loading image data")
+    getImageData()
+
     print("Initializing network")
     net = Network(params)
     total_loss = 0.0
@@ -205,6 +335,9 @@ def train(paramdict=None):
     all_losses = []
     # print_every = 20
     nowtime = time.time()
+    # Episodes are generated by background threads (bufferworkers > 0) or right before each iteration.
+    episodes = EpisodeBuffer(params, buffersize, bufferworkers) if bufferworkers > 0 else None
+    results = ResultsWriter(suffix)
     print("Starting episodes...")
     sys.stdout.flush()
 
@@ -215,14 +348,14 @@ def train(paramdict=None):
         hebb = net.initialZeroHebb()
         optimizer.zero_grad()
 
-        inputs, target = generateInputsAndTarget(params)
+        inputs, target = generateInputsAndTarget(params) if episodes is None else episodes.get()
 
         # Running the episode
         for numstep in range(params['nbsteps']):
             y, hebb = net(Variable(inputs[numstep], requires_grad=False), y, hebb)
 
-        # Computing gradients, applying optimizer
-        loss = (y[0][:params['patternsize']] - Variable(target, requires_grad=False)).pow(2).sum()
+        # Computing gradients, applying optimizer (the loss is averaged over the episodes of the batch)
+        loss = (y[:, :params['patternsize']] - Variable(target, requires_grad=False)).pow(2).sum(1).mean()
         loss.backward()
         optimizer.step()
 
@@ -233,7 +366,8 @@ def train(paramdict=None):
         if (numiter + 1) % params['print_every'] == 0:
 
             print(numiter, "====")
-            td = target.cpu().numpy()
+            # Only the first episode of the batch
+            td = target.cpu().numpy()[0]
             yd = y.data.cpu().numpy()[0][:-1]
             print("y: ", yd[:10])
             print("target: ", td[:10])
@@ -245,21 +379,17 @@ def train(paramdict=None):
             previoustime = nowtime
             nowtime = time.time()
             print("Time spent on last", params['print_every'], "iters: ", nowtime - previoustime)
+            print("Episodes per second: ", params['print_every'] * params['batchsize'] / (nowtime - previoustime))
             total_loss /= params['print_every']
             all_losses.append(total_loss)
             print("Mean loss over last", params['print_every'], "iters:", total_loss)
             print("Saving local files...")
             sys.stdout.flush()
-            with open('results_' + suffix + '.dat', 'wb') as fo:
-                pickle.dump(net.w.data.cpu().numpy(), fo)
-                pickle.dump(net.alpha.data.cpu().numpy(), fo)
-                pickle.dump(net.eta.data.cpu().numpy(), fo)
-                pickle.dump(all_losses, fo)
-                pickle.dump(params, fo)
+            results.log(total_loss)
+            # Weights are only saved on the first report after each saveevery iterations.
+            if (numiter + 1) % saveevery < params['print_every']:
+                results.checkpoint(net, all_losses, params)
             print("ETA:", net.eta.data.cpu().numpy())
-            with open('loss_' + suffix + '.txt', 'w') as thefile:
-                for item in all_losses:
-                    thefile.write("%s\n" % item)
             # Uber-only
             # print("Saving HDFS files...")
             # if checkHdfs():
@@ -271,6 +401,9 @@ def train(paramdict=None):
 
             total_loss = 0
 
+    results.checkpoint(net, all_losses, params)
+    results.close()
+
 
 @click.command()
 @click.option('--nbpatterns', default=defaultParams['nbpatterns'])
@@ -285,9 +418,20 @@ def train(paramdict=None):
 @click.option('--lr', default=defaultParams['lr'])
 @click.option('--print_every', default=defaultParams['print_every'])
 @click.option('--rngseed', default=defaultParams['rngseed'])
+@click.option('--batchsize', default=defaultParams['batchsize'])
+@click.option('--device', default='auto', type=click.Choice(['auto', 'cpu', 'gpu']))
+@click.option('--bufferworkers', default=0, help='Background threads generating episodes (0 = no buffer)')
+@click.option('--buffersize', default=16, help='Number of pre-generated episodes')
+@click.option('--saveevery', default=100, help='How often (iterations) to save the weights')
 def main(nbpatterns, nbprescycles, homogenous, prestime, prestimetest, interpresdelay, patternsize, nbiter,
-         probadegrade, lr, print_every, rngseed):
-    train(paramdict=dict(click.get_current_context().params))
+         probadegrade, lr, print_every, rngseed, batchsize, device, bufferworkers, buffersize, saveevery):
+    # The device, episode buffer and saving options are not network parameters (they are not in the file names).
+    paramdict = dict(click.get_current_context().params)
+    for key in ['device', 'bufferworkers', 'buffersize', 'saveevery']:
+        paramdict.pop(key)
+    train(
+        paramdict=paramdict, device=device, bufferworkers=bufferworkers, buffersize=buffersize, saveevery=saveevery
+    )
     # print(dict(click.get_current_context().params))
 
 
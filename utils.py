@@ -1,3 +1,9 @@
+import os
+import json
+import resource
+from collections import OrderedDict
+from threading import Lock
+from time import time
 import numpy as np
 from math import floor
 from scipy import ndimage as nd
@@ -67,18 +73,35 @@ def nfold_cross_validation(data_list, labels_list, n=5, random_state=42, val_dat
             yield tr_data, tr_labels, tst_data, tst_labels
 
 
-def get_biggest_region(labels, opening=False):
-    nu_labels = np.copy(labels)
+def get_box_opening(mask, width):
+    # Binary opening with a (width x width x width) cube. The cube is separable, so the erosion and
+    # dilation are done with 1D minimum / maximum filters along each axis (the border is background,
+    # like with binary_opening).
+    mask = mask.astype(np.uint8)
+    for axis in range(mask.ndim):
+        mask = nd.minimum_filter1d(mask, width, axis=axis, mode='constant', cval=0)
+    for axis in range(mask.ndim):
+        mask = nd.maximum_filter1d(mask, width, axis=axis, mode='constant', cval=0)
+    return mask.astype(np.bool)
+
+
+def get_biggest_region(labels, opening=False, iterations=5):
+    nu_labels = np.zeros_like(labels)
     bin_mask = labels.astype(dtype=np.bool)
+    if np.count_nonzero(bin_mask) == 0:
+        return nu_labels
+    # Everything outside the bounding box of the mask is background, so we only work inside of it.
+    bounding_box = nd.find_objects(bin_mask.astype(np.int8))[0]
+    bin_mask = bin_mask[bounding_box]
     if opening:
-        strel = nd.morphology.iterate_structure(nd.morphology.generate_binary_structure(3, 3), 5)
-        bin_op_mask = nd.morphology.binary_opening(bin_mask, strel)
+        # A 3x3x3 cube iterated n times is a (2n + 1)^3 cube.
+        bin_op_mask = get_box_opening(bin_mask, 2 * iterations + 1)
         if np.count_nonzero(bin_op_mask) > 0:
             bin_mask = bin_op_mask
-    if np.count_nonzero(bin_mask) > 0:
-        blobs, _ = nd.measurements.label(bin_mask, nd.morphology.generate_binary_structure(3, 3))
-        big_region = np.argmax(np.bincount(blobs.ravel())[1:])
-        nu_labels[blobs != big_region + 1] = 0
+    blobs, n_blobs = nd.measurements.label(bin_mask, nd.morphology.generate_binary_structure(3, 3))
+    big_region = 1 if n_blobs == 1 else np.argmax(np.bincount(blobs.ravel())[1:]) + 1
+    region_mask = blobs == big_region
+    nu_labels[bounding_box][region_mask] = labels[bounding_box][region_mask]
     return nu_labels
 
 
@@ -87,3 +110,100 @@ def get_patient_info(p):
     patient_path = '/'.join(p[0].rsplit('/')[:-1])
 
     return p_name, patient_path
+
+
+profiler = {'enabled': False, 'start': None, 'stages': OrderedDict(), 'lock': Lock()}
+
+
+def set_profiling(enabled):
+    # The stages are only timed while profiling is enabled (otherwise profile_stage returns a shared
+    # context that does nothing). Enabling it again starts a new report.
+    with profiler['lock']:
+        profiler['enabled'] = enabled
+        profiler['start'] = time() if enabled else None
+        profiler['stages'] = OrderedDict()
+
+
+def get_peak_rss():
+    # Peak resident set size of this process in MB (ru_maxrss is in KB on Linux).
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class NullStage(object):
+    # The counters written to a disabled stage are simply thrown away.
+    counters = dict()
+
+    def __enter__(self):
+        return self.counters
+
+    def __exit__(self, *args):
+        return False
+
+
+null_stage = NullStage()
+
+
+class ProfileStage(object):
+    """
+    Context manager that adds the wall time of a block (and the counters set inside of it, like
+    the number of patches or the decoded bytes) to a stage of the profiler. Stages can be nested
+    (the time of a stage includes the time of the ones inside of it) and they can be used from
+    several threads. The peak RSS is process-wide, so each stage keeps the peak at its end
+    and how much it grew while the stage was running.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.counters = dict()
+        self.ini = None
+        self.ini_rss = None
+
+    def __enter__(self):
+        self.ini_rss = get_peak_rss()
+        self.ini = time()
+        return self.counters
+
+    def __exit__(self, *args):
+        elapsed = time() - self.ini
+        peak_rss = get_peak_rss()
+        with profiler['lock']:
+            stage = profiler['stages'].setdefault(
+                self.name, {'calls': 0, 'seconds': 0., 'peak_rss_mb': 0., 'rss_growth_mb': 0.}
+            )
+            stage['calls'] += 1
+            stage['seconds'] += elapsed
+            stage['peak_rss_mb'] = max(stage['peak_rss_mb'], peak_rss)
+            stage['rss_growth_mb'] += peak_rss - self.ini_rss
+            for k, v in self.counters.items():
+                stage[k] = stage.get(k, 0) + v
+        return False
+
+
+def profile_stage(name):
+    return ProfileStage(name) if profiler['enabled'] else null_stage
+
+
+def get_profile():
+    with profiler['lock']:
+        stages = OrderedDict()
+        for name, stage in profiler['stages'].items():
+            stage = dict(stage)
+            if stage['seconds'] > 0:
+                if 'patches' in stage:
+                    stage['patches_per_second'] = stage['patches'] / stage['seconds']
+                if 'bytes' in stage:
+                    stage['mb_per_second'] = stage['bytes'] / (1024. ** 2 * stage['seconds'])
+            stages[name] = stage
+        return {
+            'seconds': time() - profiler['start'] if profiler['start'] is not None else 0.,
+            'peak_rss_mb': get_peak_rss(),
+            'stages': stages,
+        }
+
+
+def save_profile(filename):
+    # Same as with the other results, the report is written to a temporary file first.
+    tmp_name = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_name, 'w') as f:
+        json.dump(get_profile(), f, indent=2)
+    os.rename(tmp_name, filename)